@@ -0,0 +1,104 @@
+"""Count TCP connections opened towards the upstreams per Entirety route.
+
+Starts the fake FIWARE and Keycloak stack of ``fakes.py``, drives the Flask app through its test
+client and reports how many requests and how many new connections each route made. With pooled keep-alive sessions a warm route
+should not open any new connection towards the FIWARE services.
+
+Usage::
+
+    python benchmarks/bench_connections.py --iterations 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from fakes import FakeStack
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+ROUTES = [
+    '/dashboard',
+    '/orion/device',
+    '/orion/device?types=Sensor.template',
+    '/orion/devices?types=Sensor.template',
+    '/orion/subscriptions_to_json',
+    '/iotagent/device?types=Sensor.json',
+    '/iotagent/devices_to_json',
+    '/iotagent/services_to_json',
+]
+
+
+def create_client(url, workdir):
+    """Create Flask test client for the app configured against the fake stack"""
+    config = {
+        'device_idm': {'server': '{}/auth/'.format(url), 'username': 'device_wizard', 'password': 'password',
+                       'realm_name': 'n5geh_devices'},
+        'fiware': {'orion': url, 'iotagent': url, 'quantumleap': url},
+        'datamodel': {'ngsi2': os.path.join(ROOT, 'datamodel/NGSI2'),
+                      'ngsi-ld': os.path.join(ROOT, 'datamodel/NGSI-LD'),
+                      'classes': os.path.join(ROOT, 'datamodel/classes')},
+        'idm': {'account_url': '{}/account'.format(url), 'logout_link': '{}/logout'.format(url)},
+        'jobs': {'path': os.path.join(workdir, 'jobs.sqlite')}
+    }
+    secrets = {'web': {'issuer': url, 'auth_uri': url, 'client_id': 'entirety', 'client_secret': 'secret',
+                       'redirect_uris': ['http://localhost/*'], 'userinfo_uri': url, 'token_uri': url,
+                       'token_introspection_uri': url}}
+    config_file = os.path.join(workdir, 'entirety.json')
+    secrets_file = os.path.join(workdir, 'client_secrets.json')
+    json.dump(config, open(config_file, 'wt'))
+    json.dump(secrets, open(secrets_file, 'wt'))
+    os.environ['DEVICE_WIZARD_CONFIG'] = config_file
+    os.environ['CLIENT_SECRET'] = secrets_file
+
+    from itsdangerous import TimedJSONWebSignatureSerializer
+    import main
+
+    app = main.create_app(config, secrets_file)
+    # log in with a signed ID token cookie, so the requests take the path of a logged in user
+    id_token = {'sub': 'benchmark', 'exp': time.time() + 86400, 'preferred_username': 'benchmark',
+                'email': 'benchmark@localhost', 'given_name': 'Bench', 'family_name': 'Mark'}
+    client = app.test_client()
+    client.set_cookie('localhost', app.config['OIDC_ID_TOKEN_COOKIE_NAME'],
+                      TimedJSONWebSignatureSerializer(app.config['SECRET_KEY']).dumps(id_token).decode('utf-8'))
+    return client
+
+
+def run(iterations):
+    stack = FakeStack().seed_entities('Sensor', 100).seed_devices('Sensor', 100)
+    client = create_client(stack.start(), tempfile.mkdtemp(prefix='entirety-bench-'))
+
+    results = []
+    for route in ROUTES:
+        stack.reset_stats()
+        client.get(route)
+        cold = dict(stack.stats)
+        stack.reset_stats()
+        for i in range(iterations):
+            client.get(route)
+        results.append({
+            'route': route,
+            'cold_requests': cold['requests'],
+            'cold_connections': cold['connections'],
+            'requests': stack.stats['requests'] / iterations,
+            'connections': stack.stats['connections'] / iterations,
+        })
+    stack.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=10, help='warm requests per route')
+    args = parser.parse_args()
+
+    print('{:40} {:>10} {:>10} {:>10} {:>10}'.format('route', 'cold req', 'cold conn', 'req/call', 'conn/call'))
+    for r in run(args.iterations):
+        print('{route:40} {cold_requests:>10} {cold_connections:>10} {requests:>10.1f} {connections:>10.1f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
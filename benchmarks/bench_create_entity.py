@@ -0,0 +1,73 @@
+"""Micro-benchmark of Datamodel.create_entity for all shipped NGSI-LD templates.
+
+Compares rendering with the shared Datamodel environment against building a fresh Jinja environment
+for every call, which is what each register request used to do.
+
+Usage::
+
+    python benchmarks/bench_create_entity.py --iterations 200
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from datamodel import Datamodel
+
+
+def create_properties(datamodel, device_type):
+    props = {}
+    for key, value in datamodel.get_properties_dict(device_type).items():
+        (order, name, property, optional, data_type, val) = value
+        if data_type == 'datetime':
+            props[property] = datetime.datetime.now().isoformat() + 'Z'
+        else:
+            props[property] = 'benchmark-{}'.format(key)
+    return props
+
+
+def fresh_environment(datamodel, device_type, properties):
+    env = Environment(loader=FileSystemLoader(searchpath=datamodel._ngsi_ld))
+    return env.get_template(device_type).render(properties)
+
+
+def measure(func, properties, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        for device_type, props in properties.items():
+            func(device_type, props)
+    elapsed = time.perf_counter() - start
+    return iterations * len(properties) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=100, help='renders per template')
+    args = parser.parse_args()
+
+    datamodel = Datamodel({
+        'ngsi2': os.path.join(ROOT, 'datamodel/NGSI2'),
+        'ngsi-ld': os.path.join(ROOT, 'datamodel/NGSI-LD'),
+        'classes': os.path.join(ROOT, 'datamodel/classes'),
+        'bytecode_cache': tempfile.mkdtemp(prefix='entirety-jinja-')
+    })
+    properties = {t: create_properties(datamodel, t) for t in datamodel.device_types}
+
+    fresh = measure(lambda t, p: fresh_environment(datamodel, t, p), properties, args.iterations)
+    shared = measure(datamodel.create_entity, properties, args.iterations)
+
+    print('templates: {}, renders per template: {}'.format(len(properties), args.iterations))
+    print('{:30} {:>12.1f} entities/s'.format('fresh environment per call', fresh))
+    print('{:30} {:>12.1f} entities/s'.format('shared environment', shared))
+    print('{:30} {:>12.1f}x'.format('speedup', shared / fresh))
+
+
+if __name__ == '__main__':
+    main()
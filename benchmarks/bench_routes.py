@@ -0,0 +1,222 @@
+"""End-to-end benchmark of the Entirety routes against the fake FIWARE and Keycloak stack.
+
+For every data size the fake stack is seeded with that many Sensor entities and IoT Agent devices,
+the Flask app is driven through its test client and for each route the latency percentiles of the
+warm requests, the upstream requests per call (cold and warm) and the peak of memory allocated
+during one request (tracemalloc) are measured. Results are written as JSON, so runs can be
+compared, and checked against the limits of ``thresholds.json`` and optionally against the results
+of an earlier run. The exit code is 1 if any check fails.
+
+Usage::
+
+    python benchmarks/bench_routes.py --sizes 100 10000 100000 --output results.json
+    python benchmarks/bench_routes.py --baseline results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from bench_connections import create_client
+from fakes import FakeStack
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from datamodel import Datamodel
+
+DEVICE_TYPE = 'Sensor'
+TEMPLATE = 'Sensor.template'
+ENTITY = FakeStack.entity_id(DEVICE_TYPE, 1)
+TABLE = 'draw=1&start=0&length=10'
+
+ROUTES = [
+    ('dashboard', 'GET', '/dashboard'),
+    ('orion_device', 'GET', '/orion/device?types={}'.format(TEMPLATE)),
+    ('orion_device_post', 'POST', '/orion/device?types={}'.format(TEMPLATE)),
+    ('orion_edit_device', 'GET', '/orion/edit_device?type={}&id={}'.format(TEMPLATE, ENTITY)),
+    ('orion_devices', 'GET', '/orion/devices?types={}&{}'.format(TEMPLATE, TABLE)),
+    ('orion_devices_search', 'GET', '/orion/devices?types={}&{}&search[value]=0001'.format(TEMPLATE, TABLE)),
+    ('orion_subscriptions_json', 'GET', '/orion/subscriptions_to_json'),
+    ('iotagent_device', 'GET', '/iotagent/device?types={}.json'.format(DEVICE_TYPE)),
+    ('iotagent_devices_json', 'GET', '/iotagent/devices_to_json?{}'.format(TABLE)),
+    ('iotagent_devices_json_search', 'GET', '/iotagent/devices_to_json?{}&search[value]=0001'.format(TABLE)),
+    ('iotagent_services_json', 'GET', '/iotagent/services_to_json'),
+]
+
+
+def load_datamodel():
+    return Datamodel({'ngsi2': os.path.join(ROOT, 'datamodel/NGSI2'),
+                      'ngsi-ld': os.path.join(ROOT, 'datamodel/NGSI-LD'),
+                      'classes': os.path.join(ROOT, 'datamodel/classes')})
+
+
+def related_types(datamodel):
+    """Return entity types the relationship fields of the device form refer to"""
+    return sorted({value.name if value.data_type == 'select' else value.data_type
+                   for value in datamodel.get_properties_dict(TEMPLATE).values()
+                   if value.data_type not in ('string', 'datetime')})
+
+
+def form_data(datamodel, number):
+    """Return valid form data of a new device of the template"""
+    data = {}
+    for value in datamodel.get_properties_dict(TEMPLATE).values():
+        if value.data_type == 'datetime':
+            data[value.property] = '2020-01-01 00:00:00'
+        elif value.data_type == 'select':
+            data[value.property] = FakeStack.entity_id(value.name, 0)
+        elif value.data_type != 'string':
+            data[value.property] = FakeStack.entity_id(value.data_type, 0)
+        elif value.name == 'id':
+            data[value.property] = 'bench{:08d}'.format(number)
+        else:
+            data[value.property] = 'benchmark'
+    return data
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def measure_size(size, iterations, datamodel):
+    stack = FakeStack().seed_entities(DEVICE_TYPE, size).seed_devices(DEVICE_TYPE, size)
+    for entity_type in related_types(datamodel):
+        stack.seed_entities(entity_type, 10)
+    client = create_client(stack.start(), tempfile.mkdtemp(prefix='entirety-bench-'))
+    posted = [0]
+
+    def call(method, url):
+        if method == 'POST':
+            posted[0] += 1
+            return client.post(url, data=form_data(datamodel, posted[0]))
+        return client.get(url)
+
+    results = []
+    for name, method, url in ROUTES:
+        stack.reset_stats()
+        status = call(method, url).status_code
+        cold_calls = stack.stats['requests']
+
+        stack.reset_stats()
+        latencies = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            call(method, url)
+            latencies.append((time.perf_counter() - start) * 1000)
+        calls = stack.stats['requests'] / float(iterations)
+        calls_by_service = {service: count / float(iterations) for service, count in sorted(stack.calls.items())}
+
+        tracemalloc.start()
+        call(method, url)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results.append({
+            'size': size,
+            'route': name,
+            'method': method,
+            'url': url,
+            'status': status,
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p90_ms': round(percentile(latencies, 0.9), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'max_ms': round(max(latencies), 2),
+            'cold_upstream_calls': cold_calls,
+            'upstream_calls': calls,
+            'upstream_calls_by_service': calls_by_service,
+            'peak_kb': round(peak / 1024.0, 1),
+        })
+    stack.shutdown()
+    return results
+
+
+def run(sizes, iterations):
+    datamodel = load_datamodel()
+    results = []
+    for size in sizes:
+        results.extend(measure_size(size, iterations, datamodel))
+    return {
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'iterations': iterations,
+        'sizes': sizes,
+        'results': results,
+    }
+
+
+def limits_for(thresholds, result):
+    limits = dict(thresholds.get('limits', {}).get('*', {}))
+    limits.update(thresholds.get('limits', {}).get(result['route'], {}))
+    limits.update(thresholds.get('limits', {}).get('{}@{}'.format(result['route'], result['size']), {}))
+    return limits
+
+
+def check(report, thresholds, baseline=None):
+    """Return list of failed checks of the report against the thresholds and the baseline report"""
+    failures = []
+    previous = {}
+    if baseline is not None:
+        previous = {(r['route'], r['size']): r for r in baseline['results']}
+    tolerance = thresholds.get('tolerance', 1.5)
+    slack = thresholds.get('latency_slack_ms', 5)
+
+    for result in report['results']:
+        label = '{}@{}'.format(result['route'], result['size'])
+        if result['status'] >= 400:
+            failures.append('{}: status {}'.format(label, result['status']))
+        for key, limit in sorted(limits_for(thresholds, result).items()):
+            if result[key] > limit:
+                failures.append('{}: {} {} exceeds limit {}'.format(label, key, result[key], limit))
+        before = previous.get((result['route'], result['size']))
+        if before is None:
+            continue
+        if result['p90_ms'] > before['p90_ms'] * tolerance + slack:
+            failures.append('{}: p90_ms {} regressed from {}'.format(label, result['p90_ms'], before['p90_ms']))
+        if result['upstream_calls'] > before['upstream_calls']:
+            failures.append('{}: upstream_calls {} increased from {}'.format(
+                label, result['upstream_calls'], before['upstream_calls']))
+        if result['peak_kb'] > before['peak_kb'] * tolerance:
+            failures.append('{}: peak_kb {} regressed from {}'.format(label, result['peak_kb'], before['peak_kb']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='number of seeded entities and devices')
+    parser.add_argument('--iterations', type=int, default=20, help='warm requests per route and size')
+    parser.add_argument('--output', default='bench_routes.json', help='file the results are written to')
+    parser.add_argument('--thresholds', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'thresholds.json'))
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.iterations)
+    with open(args.output, 'wt') as f:
+        json.dump(report, f, indent=2)
+
+    print('{:30} {:>7} {:>9} {:>9} {:>9} {:>7} {:>7} {:>10}'.format(
+        'route', 'size', 'p50 ms', 'p90 ms', 'p99 ms', 'cold', 'calls', 'peak KB'))
+    for r in report['results']:
+        print('{route:30} {size:>7} {p50_ms:>9.1f} {p90_ms:>9.1f} {p99_ms:>9.1f} {cold_upstream_calls:>7} '
+              '{upstream_calls:>7.1f} {peak_kb:>10.1f}'.format(**r))
+
+    thresholds = json.load(open(args.thresholds, 'rt')) if os.path.exists(args.thresholds) else {}
+    baseline = json.load(open(args.baseline, 'rt')) if args.baseline else None
+    failures = check(report, thresholds, baseline)
+    for failure in failures:
+        print('FAIL {}'.format(failure))
+    print('Results written to {}'.format(args.output))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
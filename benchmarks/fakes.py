@@ -0,0 +1,544 @@
+"""In-memory stand-ins for the FIWARE and Keycloak APIs used by Entirety.
+
+A ``FakeStack`` answers the subset of Orion LD (NGSI-LD entities, entity operations, v2
+subscriptions), IoT Agent (``/iot/services``, ``/iot/devices``), QuantumLeap and Keycloak (token,
+userinfo, introspection, admin users) which the Entirety clients call, on one local HTTP server.
+Latency and error injection can be set globally or per service, data volumes are seeded without
+building every entity up front, so 50k entities per type stay cheap. Requests and connections are
+counted per service for the benchmarks.
+
+Run it standalone and point the ``fiware`` and ``device_idm`` config of Entirety at it::
+
+    python benchmarks/fakes.py --port 1026 --entities Sensor=50000 --devices 10000 --latency 0.005
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from urllib.parse import parse_qs, unquote, urlsplit
+
+CONTEXT = 'http://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld'
+ERRORS = 'https://uri.etsi.org/ngsi-ld/errors/'
+
+
+class SeededStore(object):
+    """Ordered collection of generated and stored items.
+
+    Seeded items are only kept as keys and built by ``factory(key)`` when they are read. Items
+    created or changed later are stored as they are.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.keys = {}
+        self.items = {}
+
+    def seed(self, keys):
+        for key in keys:
+            self.keys.setdefault(key, None)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key):
+        if key not in self.keys:
+            return None
+        item = self.items.get(key)
+        return item if item is not None else self.factory(key)
+
+    def put(self, key, item):
+        self.keys.setdefault(key, None)
+        self.items[key] = item
+
+    def remove(self, key):
+        if key not in self.keys:
+            return False
+        del self.keys[key]
+        self.items.pop(key, None)
+        return True
+
+    def page(self, offset, limit, keys=None):
+        keys = self.keys if keys is None else keys
+        return [self.get(key) for key in islice(keys, offset, offset + limit)]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stack.count_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, payload, headers = self.server.stack.handle(self.command, url.path, parse_qs(url.query), body)
+        content = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+
+class FakeStack(object):
+    """Stateful fake of Orion LD, IoT Agent, QuantumLeap and Keycloak behind one HTTP server.
+
+    ``latency`` (seconds) and ``error_rate`` (0..1, answered with ``error_status``) are numbers or
+    dicts of service name (orion, iotagent, keycloak or version for the version probes of all
+    services) -> number. ``latency`` is the mean of a uniform delay of +-``jitter``. ``seed``
+    makes error injection and jitter repeatable.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.server = None
+        self.stats = {'connections': 0, 'requests': 0}
+        self.calls = Counter()
+
+        self.entities = {}
+        self.subscriptions = OrderedDict()
+        self.services = OrderedDict()
+        self.devices = SeededStore(self._device)
+        self.device_types = {}
+        self.users = SeededStore(self._user)
+        self.usernames = {}
+
+        self.routes = [
+            ('GET', r'/(v2/)?version', 'version', self.version),
+            ('GET', r'/ngsi-ld/v1/entities', 'orion', self.query_entities),
+            ('POST', r'/ngsi-ld/v1/entities', 'orion', self.create_entity),
+            ('GET', r'/ngsi-ld/v1/entities/(?P<id>[^/]+)', 'orion', self.get_entity),
+            ('DELETE', r'/ngsi-ld/v1/entities/(?P<id>[^/]+)', 'orion', self.delete_entity),
+            ('POST', r'/ngsi-ld/v1/entities/(?P<id>[^/]+)/attrs', 'orion', self.update_entity),
+            ('PATCH', r'/ngsi-ld/v1/entities/(?P<id>[^/]+)/attrs', 'orion', self.update_entity),
+            ('POST', r'/ngsi-ld/v1/entityOperations/(?P<operation>create|upsert|delete)', 'orion',
+             self.entity_operation),
+            ('GET', r'/v2/subscriptions', 'orion', self.get_subscriptions),
+            ('POST', r'/v2/subscriptions', 'orion', self.create_subscription),
+            ('DELETE', r'/v2/subscriptions/(?P<id>[^/]+)', 'orion', self.delete_subscription),
+            ('GET', r'/iot/services/?', 'iotagent', self.get_services),
+            ('POST', r'/iot/services/?', 'iotagent', self.create_services),
+            ('DELETE', r'/iot/services/?', 'iotagent', self.delete_service),
+            ('GET', r'/iot/devices/?', 'iotagent', self.get_devices),
+            ('POST', r'/iot/devices/?', 'iotagent', self.create_devices),
+            ('GET', r'/iot/devices/(?P<id>[^/]+)', 'iotagent', self.get_device),
+            ('DELETE', r'/iot/devices/(?P<id>[^/]+)', 'iotagent', self.delete_device),
+            ('POST', r'/(auth/)?realms/[^/]+/protocol/openid-connect/token', 'keycloak', self.token),
+            ('GET', r'/(auth/)?realms/[^/]+/protocol/openid-connect/userinfo', 'keycloak', self.userinfo),
+            ('POST', r'/(auth/)?realms/[^/]+/protocol/openid-connect/userinfo', 'keycloak', self.userinfo),
+            ('POST', r'/(auth/)?realms/[^/]+/protocol/openid-connect/token/introspect', 'keycloak',
+             self.introspect),
+            ('GET', r'/(auth/)?admin/realms/[^/]+/users', 'keycloak', self.get_users),
+            ('POST', r'/(auth/)?admin/realms/[^/]+/users', 'keycloak', self.create_user),
+            ('GET', r'/(auth/)?admin/realms/[^/]+/users/count', 'keycloak', self.count_users),
+            ('DELETE', r'/(auth/)?admin/realms/[^/]+/users/(?P<id>[^/]+)', 'keycloak', self.delete_user),
+        ]
+        self.routes = [(method, re.compile(pattern + '$'), service, handler)
+                       for method, pattern, service, handler in self.routes]
+
+    # Seeding
+
+    @staticmethod
+    def entity_id(entity_type, number):
+        return 'urn:ngsi-ld:{}:{:06d}'.format(entity_type, number)
+
+    def seed_entities(self, entity_type, count):
+        """Add ``count`` generated NGSI-LD entities of the type"""
+        store = self.entities.get(entity_type)
+        if store is None:
+            store = self.entities[entity_type] = SeededStore(lambda i, t=entity_type: self._entity(t, i))
+        start = len(store)
+        store.seed(self.entity_id(entity_type, number) for number in range(start, start + count))
+        return self
+
+    def seed_devices(self, entity_type, count, service=True):
+        """Add ``count`` generated IoT Agent devices of the type and their service"""
+        start = len(self.devices)
+        ids = ['{}{:06d}'.format(entity_type.lower(), number) for number in range(start, start + count)]
+        for device_id in ids:
+            self.device_types[device_id] = entity_type
+        self.devices.seed(ids)
+        if service:
+            self.services[('fake{}'.format(entity_type.lower()), '/iot/d')] = self._service(entity_type)
+        return self
+
+    def seed_users(self, count):
+        start = len(self.users)
+        ids = ['{:08d}-0000-0000-0000-000000000000'.format(number) for number in range(start, start + count)]
+        for user_id in ids:
+            self.usernames[self._user(user_id)['username']] = user_id
+        self.users.seed(ids)
+        return self
+
+    def _entity(self, entity_type, entity_id):
+        return {
+            'id': entity_id,
+            'type': entity_type,
+            '@context': [CONTEXT],
+            'category': {'type': 'Property', 'value': 'Device'},
+            'ipAddress': {'type': 'Property', 'value': '10.0.{}.{}'.format(len(entity_id) % 250, entity_id[-2:])},
+            'hasState': {'type': 'Relationship', 'object': ['urn:ngsi-ld:State:000000']},
+        }
+
+    def _device(self, device_id):
+        entity_type = self.device_types.get(device_id, 'Device')
+        return {'device_id': device_id, 'service': 'openiot', 'service_path': '/',
+                'entity_name': 'urn:ngsi-ld:{}:{}'.format(entity_type, device_id), 'entity_type': entity_type,
+                'transport': 'MQTT', 'attributes': [], 'lazy': [], 'commands': [], 'static_attributes': [],
+                'protocol': 'PDI-IoTA-UltraLight'}
+
+    @staticmethod
+    def _service(entity_type):
+        return {'apikey': 'fake{}'.format(entity_type.lower()), 'resource': '/iot/d', 'entity_type': entity_type,
+                'cbroker': 'http://orion:1026', 'protocol': 'PDI-IoTA-UltraLight', 'transport': 'MQTT'}
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'username': 'user{}'.format(user_id[:8]), 'enabled': True}
+
+    # Server
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve on a background thread, return the base url"""
+        self.server = ThreadingHTTPServer((host, port), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.stack = self
+        threading.Thread(target=self.server.serve_forever, name='fake-stack', daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_connection(self):
+        with self.lock:
+            self.stats['connections'] += 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.update(connections=0, requests=0)
+            self.calls.clear()
+
+    def _setting(self, value, service):
+        if isinstance(value, dict):
+            return value.get(service, 0.0)
+        return value
+
+    def handle(self, method, path, query, body):
+        """Return status, JSON payload and headers of the request"""
+        path = unquote(path)
+        for route_method, pattern, service, handler in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {'type': ERRORS + 'ResourceNotFound', 'title': 'No route', 'detail': path}, {}
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.calls[service] += 1
+            delay = self._setting(self.latency, service)
+            if self.jitter:
+                delay = max(delay + self.random.uniform(-self.jitter, self.jitter), 0)
+            failed = self.random.random() < self._setting(self.error_rate, service)
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return self.error_status, {'type': ERRORS + 'InternalError', 'title': 'Injected error'}, {}
+
+        params = {key: values[-1] for key, values in query.items()}
+        try:
+            data = json.loads(body.decode('utf-8')) if body and body[:1] in (b'{', b'[') else body
+        except ValueError:
+            return 400, {'type': ERRORS + 'InvalidRequest', 'title': 'Invalid JSON'}, {}
+        with self.lock:
+            result = handler(params, data, **match.groupdict())
+        if len(result) == 2:
+            return result + ({},)
+        return result
+
+    # Orion LD
+
+    def version(self, params, data):
+        return 200, {'orionld version': 'fake', 'version': 'fake'}
+
+    def _entity_store(self, entity_id):
+        for store in self.entities.values():
+            if entity_id in store:
+                return store
+        return None
+
+    def query_entities(self, params, data):
+        types = [t for t in params.get('type', '').split(',') if t]
+        pattern = re.compile(params['idPattern']) if 'idPattern' in params else None
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 20))
+        matches = []
+        for entity_type in types or list(self.entities):
+            store = self.entities.get(entity_type)
+            if store is None:
+                continue
+            keys = store.keys if pattern is None else [key for key in store.keys if pattern.match(key)]
+            matches.append((store, keys))
+        total = sum(len(keys) for _, keys in matches)
+
+        page = []
+        for store, keys in matches:
+            if offset >= len(keys):
+                offset -= len(keys)
+                continue
+            page.extend(store.page(offset, limit - len(page), keys))
+            offset = 0
+            if len(page) >= limit:
+                break
+        if params.get('options') == 'keyValues':
+            page = [self._key_values(entity) for entity in page]
+        if 'pick' in params:
+            attributes = set(params['pick'].split(','))
+            page = [{key: value for key, value in entity.items() if key in attributes} for entity in page]
+        headers = {'NGSILD-Results-Count': str(total)} if params.get('count') == 'true' else {}
+        return 200, page, headers
+
+    @staticmethod
+    def _key_values(entity):
+        values = {}
+        for key, value in entity.items():
+            if isinstance(value, dict) and value.get('type') == 'Property':
+                value = value.get('value')
+            elif isinstance(value, dict) and value.get('type') == 'Relationship':
+                value = value.get('object')
+            values[key] = value
+        return values
+
+    def _not_found(self, entity_id):
+        return 404, {'type': ERRORS + 'ResourceNotFound', 'title': 'Entity not found', 'detail': entity_id}
+
+    def get_entity(self, params, data, id):
+        store = self._entity_store(id)
+        if store is None:
+            return self._not_found(id)
+        entity = store.get(id)
+        return 200, self._key_values(entity) if params.get('options') == 'keyValues' else entity
+
+    def _store_entity(self, entity, replace=False):
+        """Store entity, return False if it exists and is not replaced"""
+        store = self._entity_store(entity['id'])
+        if store is not None and not replace:
+            return False
+        if store is None:
+            self.seed_entities(entity['type'], 0)
+            store = self.entities[entity['type']]
+        store.put(entity['id'], entity)
+        return True
+
+    def create_entity(self, params, data):
+        if not isinstance(data, dict) or 'id' not in data or 'type' not in data:
+            return 400, {'type': ERRORS + 'BadRequestData', 'title': 'id and type are required'}
+        if not self._store_entity(data):
+            return 409, {'type': ERRORS + 'AlreadyExists', 'title': 'Entity already exists', 'detail': data['id']}
+        return 201, None, {'Location': '/ngsi-ld/v1/entities/{}'.format(data['id'])}
+
+    def update_entity(self, params, data, id):
+        store = self._entity_store(id)
+        if store is None:
+            return self._not_found(id)
+        entity = dict(store.get(id))
+        entity.update({key: value for key, value in data.items() if key != '@context'})
+        store.put(id, entity)
+        return 204, None
+
+    def delete_entity(self, params, data, id):
+        store = self._entity_store(id)
+        if store is None:
+            return self._not_found(id)
+        store.remove(id)
+        return 204, None
+
+    def entity_operation(self, params, data, operation):
+        success = []
+        errors = []
+        for item in data:
+            if operation == 'delete':
+                store = self._entity_store(item)
+                if store is None:
+                    errors.append({'entityId': item, 'error': {'type': ERRORS + 'ResourceNotFound', 'status': 404,
+                                                               'title': 'Entity not found'}})
+                else:
+                    store.remove(item)
+                    success.append(item)
+            elif self._store_entity(item, replace=operation == 'upsert'):
+                success.append(item['id'])
+            else:
+                errors.append({'entityId': item['id'], 'error': {'type': ERRORS + 'AlreadyExists', 'status': 409,
+                                                                 'title': 'Entity already exists'}})
+        if not errors:
+            return (204, None) if operation == 'delete' else (201, success)
+        return 207, {'success': success, 'errors': errors}
+
+    def get_subscriptions(self, params, data):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 20))
+        page = list(self.subscriptions.values())[offset:offset + limit]
+        headers = {'Fiware-Total-Count': str(len(self.subscriptions))} if 'count' in params.get('options', '') else {}
+        return 200, page, headers
+
+    def create_subscription(self, params, data):
+        subscription_id = uuid.uuid4().hex[:24]
+        self.subscriptions[subscription_id] = dict(data, id=subscription_id, status='active')
+        return 201, None, {'Location': '/v2/subscriptions/{}'.format(subscription_id)}
+
+    def delete_subscription(self, params, data, id):
+        if self.subscriptions.pop(id, None) is None:
+            return 404, {'error': 'NotFound', 'description': 'The requested subscription has not been found'}
+        return 204, None
+
+    # IoT Agent
+
+    def get_services(self, params, data):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 20))
+        services = list(self.services.values())
+        return 200, {'count': len(services), 'services': services[offset:offset + limit]}
+
+    def create_services(self, params, data):
+        services = data.get('services', [])
+        if any((s.get('apikey'), s.get('resource')) in self.services for s in services):
+            return 409, {'name': 'DUPLICATE_GROUP', 'message': 'A device configuration already exists'}
+        for service in services:
+            self.services[(service.get('apikey'), service.get('resource'))] = service
+        return 201, {}
+
+    def delete_service(self, params, data):
+        if self.services.pop((params.get('apikey'), params.get('resource')), None) is None:
+            return 404, {'name': 'DEVICE_GROUP_NOT_FOUND', 'message': 'Could not find device group'}
+        return 204, None
+
+    def get_devices(self, params, data):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 20))
+        return 200, {'count': len(self.devices), 'devices': self.devices.page(offset, limit)}
+
+    def create_devices(self, params, data):
+        devices = data.get('devices', [])
+        for device in devices:
+            if device.get('device_id') in self.devices:
+                return 409, {'name': 'DUPLICATE_DEVICE_ID', 'message': 'Duplicate device id {}'.format(
+                    device.get('device_id'))}
+        for device in devices:
+            self.devices.put(device['device_id'], device)
+        return 201, {}
+
+    def get_device(self, params, data, id):
+        device = self.devices.get(id)
+        if device is None:
+            return 404, {'name': 'DEVICE_NOT_FOUND', 'message': 'No device was found with id:{}'.format(id)}
+        return 200, device
+
+    def delete_device(self, params, data, id):
+        if not self.devices.remove(id):
+            return 404, {'name': 'DEVICE_NOT_FOUND', 'message': 'No device was found with id:{}'.format(id)}
+        return 204, None
+
+    # Keycloak
+
+    def token(self, params, data):
+        return 200, {'access_token': 'fake', 'refresh_token': 'fake', 'id_token': 'fake', 'expires_in': 300,
+                     'refresh_expires_in': 1800, 'token_type': 'bearer', 'scope': 'openid email profile'}
+
+    def userinfo(self, params, data):
+        return 200, {'sub': 'fake', 'preferred_username': 'admin', 'email': 'admin@example.com',
+                     'given_name': 'Fake', 'family_name': 'Admin'}
+
+    def introspect(self, params, data):
+        return 200, {'active': True, 'scope': 'openid email profile', 'client_id': 'entirety', 'username': 'admin',
+                     'exp': int(time.time()) + 300}
+
+    def get_users(self, params, data):
+        search = params.get('search', params.get('username', '')).lower()
+        first = int(params.get('first', 0))
+        limit = int(params.get('max', 100))
+        if search:
+            keys = [user_id for name, user_id in self.usernames.items() if search in name]
+        else:
+            keys = self.users.keys
+        return 200, self.users.page(first, limit, keys)
+
+    def create_user(self, params, data):
+        username = data.get('username', '').lower()
+        if username in self.usernames:
+            return 409, {'errorMessage': 'User exists with same username'}
+        user_id = str(uuid.uuid4())
+        self.users.put(user_id, dict(data, id=user_id, username=username))
+        self.usernames[username] = user_id
+        return 201, None, {'Location': '/auth/admin/realms/fake/users/{}'.format(user_id)}
+
+    def count_users(self, params, data):
+        return 200, len(self.users)
+
+    def delete_user(self, params, data, id):
+        user = self.users.get(id)
+        if user is None:
+            return 404, {'error': 'User not found'}
+        self.users.remove(id)
+        self.usernames.pop(user['username'], None)
+        return 204, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1026)
+    parser.add_argument('--entities', action='append', default=[], metavar='TYPE=COUNT',
+                        help='seeded NGSI-LD entities, e.g. Sensor=50000, can be repeated')
+    parser.add_argument('--devices', type=int, default=0, help='seeded IoT Agent devices of type Sensor')
+    parser.add_argument('--users', type=int, default=0, help='seeded Keycloak users')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every response in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    args = parser.parse_args()
+
+    stack = FakeStack(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    for item in args.entities:
+        entity_type, count = item.split('=')
+        stack.seed_entities(entity_type, int(count))
+    stack.seed_devices('Sensor', args.devices).seed_users(args.users)
+    print('Serving fake FIWARE and Keycloak APIs on {}'.format(stack.start(args.host, args.port)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stack.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import time
+
+from flask import g
+from flask_oidc import OpenIDConnect
+
+from cache import TTLCache
+import timing
+
+
+class CachedOpenIDConnect(OpenIDConnect):
+    """OpenIDConnect which caches the UserInfo and token introspection replies of the IDM.
+
+    User info is cached per subject for ``userinfo_ttl`` seconds and introspection results per
+    token for ``introspection_ttl`` seconds, but never beyond the expiry of the ID token or the
+    introspected token. The caches are local to the worker process, so a revoked token can be
+    accepted by a worker until its cached introspection result expires.
+    """
+    userinfo_ttl = 300
+    introspection_ttl = 60
+    maxsize = 1024
+
+    def __init__(self, app=None, config={}, **kwargs):
+        maxsize = config.get('maxsize', self.maxsize)
+        self.userinfo_cache = TTLCache(ttl=config.get('userinfo_ttl', self.userinfo_ttl), maxsize=maxsize,
+                                       name='userinfo')
+        self.introspection_cache = TTLCache(ttl=config.get('introspection_ttl', self.introspection_ttl),
+                                            maxsize=maxsize, name='introspection')
+        super(CachedOpenIDConnect, self).__init__(app, **kwargs)
+
+    @staticmethod
+    def _lifetime(expires_at):
+        """Return seconds until the expiry timestamp or None if there is none"""
+        if not isinstance(expires_at, (int, float)):
+            return None
+        return expires_at - time.time()
+
+    @staticmethod
+    def _token_key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _retrieve_userinfo(self, access_token=None):
+        if access_token is None:
+            key = ('sub', g.oidc_id_token['sub'])
+            lifetime = self._lifetime(g.oidc_id_token.get('exp'))
+        else:
+            key = ('token', self._token_key(access_token))
+            lifetime = None
+        info = self.userinfo_cache.get(key)
+        if info is None:
+            with timing.span('oidc'):
+                info = super(CachedOpenIDConnect, self)._retrieve_userinfo(access_token)
+            if info is not None:
+                self.userinfo_cache.set(key, info, lifetime)
+        return info
+
+    def _get_token_info(self, token):
+        key = self._token_key(token)
+        info = self.introspection_cache.get(key)
+        if info is None:
+            with timing.span('oidc'):
+                info = super(CachedOpenIDConnect, self)._get_token_info(token)
+            self.introspection_cache.set(key, info, self._lifetime(info.get('exp')))
+        return info
+
+    def logout(self):
+        if g.oidc_id_token is not None:
+            self.userinfo_cache.pop(('sub', g.oidc_id_token['sub']))
+        super(CachedOpenIDConnect, self).logout()
+
+    def cache_stats(self):
+        return {'userinfo': self.userinfo_cache.stats(), 'introspection': self.introspection_cache.stats()}
@@ -0,0 +1,268 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import sys
+from collections.abc import Mapping
+from functools import partial
+
+import os
+
+from datamodel import Datamodel
+from fiware import Orion, IoTAgent
+from forms import FormService
+from idm import IDM
+
+
+class BulkImporter(object):
+    """Provision many IoT Agent devices of one NGSI2 type from CSV or JSONL rows.
+
+    Every row is validated against the device definition first. The service of the type is created
+    once if it is missing and valid devices are sent to the IoT Agent in batches of ``batch_size``.
+    If a batch is rejected its devices are sent one by one, so the report tells which rows failed.
+    The IoT Agent may have registered some devices of a rejected batch; those are told apart from
+    devices which existed before by their missing MQTT user.
+    """
+    batch_size = 50
+
+    def __init__(self, iotagent, idm, datamodel, formservice, orion=None, config={}):
+        self.iotagent = iotagent
+        self.idm = idm
+        self.datamodel = datamodel
+        self.formservice = formservice
+        self.orion = orion
+        self.batch_size = config.get('batch_size', self.batch_size)
+
+    @staticmethod
+    def read_rows(stream, filename=''):
+        """Read rows from a text stream of CSV, or JSON lines if the file name ends with .jsonl"""
+        if filename.endswith('.jsonl') or filename.endswith('.json'):
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(stream):
+                yield row
+
+    def fields(self, device_type):
+        """Return list of (name, required, query) of the input fields of the device type"""
+        definition = self.datamodel.get_iotdevice_definition(device_type)
+        fields = []
+        for value in definition.values():
+            if isinstance(value, Mapping):
+                fields.append((value['name'], value['required'] == 'true', None))
+        for attr in definition['static_attributes']:
+            query = attr.get('query') if attr['type'] != 'Property' else None
+            fields.append((attr['name'], attr['required'] == 'true', query or None))
+        return fields
+
+    def validate(self, device_type, rows):
+        """Return list of row reports, valid rows carry the params of the device"""
+        fields = self.fields(device_type)
+        provider = self.formservice.get_provider(self.orion) if self.orion is not None else None
+        if provider is not None:
+            provider.get_indexes(query for _, _, query in fields if query)
+
+        reports = []
+        seen = set()
+        for number, row in enumerate(rows, start=1):
+            params = {}
+            errors = []
+            if not isinstance(row, Mapping):
+                row = {}
+                errors.append('Row is not an object')
+            for name, required, query in fields:
+                value = row.get(name)
+                value = '' if value is None else str(value).strip()
+                if required and not value:
+                    errors.append('{} is required'.format(name))
+                elif value and query and provider is not None and not provider.contains(query, value):
+                    errors.append('{} {} does not exist'.format(query, value))
+                params[name] = value
+            device_id = params.get('device_id', '')
+            if device_id in seen:
+                errors.append('Duplicate device_id {}'.format(device_id))
+            seen.add(device_id)
+            report = {'row': number, 'device_id': device_id, 'status': 'invalid' if errors else 'valid',
+                      'errors': errors}
+            if not errors:
+                report['device'] = self.formservice.create_iotdevice(device_type, params, self.datamodel)
+            reports.append(report)
+        return reports
+
+    def ensure_service(self, device_type):
+        """Create the service of the device type unless it already exists"""
+        return self.iotagent.ensure_service(IDM.create_apikey(device_type), device_type)
+
+    def send(self, devices):
+        """Send devices to the IoT Agent, return status code and error message"""
+        try:
+            r = self.iotagent.create_devices(devices)
+        except Exception as e:
+            logging.error('Could not provision devices: {}'.format(e))
+            return None, str(e)
+        if r.status_code == 201:
+            return r.status_code, None
+        try:
+            message = r.json().get('message', r.text)
+        except ValueError:
+            message = r.text
+        return r.status_code, message or str(r.status_code)
+
+    def provision(self, reports, progress=None):
+        """Send devices of the valid rows in batches and record the result in the reports"""
+        valid = [report for report in reports if report['status'] == 'valid']
+        for start in range(0, len(valid), self.batch_size):
+            if progress is not None:
+                progress(start, len(valid))
+            batch = valid[start:start + self.batch_size]
+            status_code, error = self.send([report['device'] for report in batch])
+            if status_code == 201:
+                for report in batch:
+                    report['status'] = 'created'
+                continue
+            for report in batch:
+                status_code, error = self.send([report['device']])
+                if status_code == 201:
+                    report['status'] = 'created'
+                elif status_code == 409:
+                    report['status'] = 'created' if len(batch) > 1 and self.lacks_user(report['device']) \
+                        else 'exists'
+                else:
+                    report['status'] = 'failed'
+                    report['errors'].append(error)
+        if progress is not None:
+            progress(len(valid), len(valid))
+
+    def lacks_user(self, device):
+        """Check if the existing device has no MQTT user yet, i.e. the rejected batch created it"""
+        if self.idm is None:
+            return False
+        try:
+            return not self.idm.entity_exists(device['entity_name'])
+        except Exception as e:
+            logging.error('Could not look up user of {}: {}'.format(device['entity_name'], e))
+            return False
+
+    def register_users(self, reports):
+        """Create the MQTT users of the created devices"""
+        for report in reports:
+            if report['status'] != 'created':
+                continue
+            device = report['device']
+            try:
+                self.idm.create_entity(device['entity_name'], device['entity_type'])
+            except Exception as e:
+                logging.error('Could not create user of {}: {}'.format(device['entity_name'], e))
+                report['errors'].append('Could not create user: {}'.format(e))
+
+    def run(self, device_type, rows, progress=None):
+        """Import the rows, return report with the per-row results and counts by status.
+
+        ``progress(done, total)`` is called before each batch with the number of provisioned devices.
+        """
+        reports = self.validate(device_type, rows)
+        if any(report['status'] == 'valid' for report in reports):
+            result = self.ensure_service(device_type)
+            if not result['status']:
+                for report in reports:
+                    if report['status'] == 'valid':
+                        report['status'] = 'failed'
+                        report['errors'].append('Could not create service: {}'.format(result['error']))
+        self.provision(reports, progress)
+        self.register_users(reports)
+
+        summary = {}
+        for report in reports:
+            report.pop('device', None)
+            summary[report['status']] = summary.get(report['status'], 0) + 1
+        return {'type': device_type, 'summary': summary, 'rows': reports}
+
+
+class BulkDeleter(object):
+    """Delete many Orion or IoT Agent devices together with their Keycloak users.
+
+    Upstream deletes run concurrently on the ``fanout`` pool. The user of a device is only removed
+    once the device is gone, i.e. deleted or not found, so a device whose delete failed keeps its
+    MQTT credentials; its user is reported as ``skipped``.
+    """
+
+    def __init__(self, orion, iotagent, idm, fanout):
+        self.orion = orion
+        self.iotagent = iotagent
+        self.idm = idm
+        self.fanout = fanout
+
+    def delete_users(self, report):
+        """Remove Keycloak users of the devices in the report which are gone"""
+        gone = [r['id'] for r in report if r['status'] in ('deleted', 'not_found')]
+        results, missing = self.fanout.run({i: partial(self.idm.delete_entity, i) for i in gone})
+        for r in report:
+            if r['status'] not in ('deleted', 'not_found'):
+                r['user'] = 'skipped'
+            elif r['id'] in missing:
+                r['user'] = 'failed'
+            else:
+                r['user'] = 'deleted' if results[r['id']] else 'not_found'
+        return report
+
+    def delete_orion(self, ids, progress=None):
+        """Delete entities from Orion in batches and their users, return per-id report"""
+        report = []
+        for start in range(0, len(ids), self.orion.batch_size):
+            report.extend(self.delete_users(self.orion.batch_delete(ids[start:start + self.orion.batch_size])))
+            if progress is not None:
+                progress(len(report), len(ids))
+        return report
+
+    def delete_iotagent(self, ids, progress=None):
+        """Delete devices from the IoT Agent concurrently and their users, return per-id report"""
+        report = []
+        chunk_size = self.fanout.max_workers * 4
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            results, missing = self.fanout.run({i: partial(self.iotagent.delete_entity, i) for i in chunk})
+            deleted = []
+            for i in chunk:
+                if i in missing:
+                    deleted.append({'id': i, 'status': 'failed', 'error': 'No response'})
+                elif results[i].status_code == 204:
+                    deleted.append({'id': i, 'status': 'deleted', 'error': None})
+                elif results[i].status_code == 404:
+                    deleted.append({'id': i, 'status': 'not_found', 'error': None})
+                else:
+                    deleted.append({'id': i, 'status': 'failed', 'error': results[i].text})
+            report.extend(self.delete_users(deleted))
+            if progress is not None:
+                progress(len(report), len(ids))
+        return report
+
+
+def main(argv=None):
+    """Import devices from the command line using the Entirety configuration"""
+    parser = argparse.ArgumentParser(description='Provision IoT Agent devices from a CSV or JSONL file')
+    parser.add_argument('file', help='CSV file with a header row or JSONL file with one device per line')
+    parser.add_argument('--type', required=True, help='NGSI2 device type, e.g. Sensor.json')
+    parser.add_argument('--config', default=os.environ.get('DEVICE_WIZARD_CONFIG', 'entirety.json'),
+                        help='Entirety configuration file')
+    parser.add_argument('--batch-size', type=int, default=BulkImporter.batch_size)
+    args = parser.parse_args(argv)
+
+    config = json.load(open(args.config, 'rt'))
+    datamodel = Datamodel(config=config['datamodel'])
+    if args.type not in datamodel.iotdevice_types:
+        parser.error('Unknown device type {}'.format(args.type))
+    orion = Orion(config=config['fiware'])
+    importer = BulkImporter(IoTAgent(config=config['fiware']), IDM(config=config['device_idm']), datamodel,
+                            FormService(), orion, config={'batch_size': args.batch_size})
+
+    with io.open(args.file, 'rt', encoding='utf-8-sig', newline='') as f:
+        report = importer.run(args.type, importer.read_rows(f, args.file))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0 if set(report['summary']) <= {'created', 'exists'} else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
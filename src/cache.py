@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class TTLCache(object):
+    """Thread safe in-memory cache whose entries expire ``ttl`` seconds after they were stored.
+
+    The cache holds at most ``maxsize`` entries, the least recently used one is dropped first. It is
+    local to the worker process, so invalidation does not reach other uwsgi workers; ttl bounds
+    how long they can serve stale values. Lookups of a cache with a ``name`` are counted in the
+    Prometheus metrics.
+    """
+    ttl = 30
+    maxsize = 1024
+
+    def __init__(self, ttl=None, maxsize=None, name=None):
+        self.name = name
+        if ttl is not None:
+            self.ttl = ttl
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.time():
+                self._items.pop(key, None)
+                self.misses += 1
+                metrics.record_cache(self.name, False)
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+        metrics.record_cache(self.name, True)
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        """Store value, ``ttl`` overrides the lifetime of this entry if it is shorter"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.time() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,108 @@
+import logging
+from bisect import bisect_left
+
+from cache import TTLCache
+
+
+class IdIndex(object):
+    """Sorted entity ids of one type for prefix search.
+
+    Queries starting with ``urn:`` are matched against the whole ids, others case-insensitively
+    against the name part behind ``urn:ngsi-ld:<type>:``.
+    """
+
+    def __init__(self, entity_type, ids):
+        self.ids = sorted(ids)
+        self._members = frozenset(self.ids)
+        prefix = 'urn:ngsi-ld:{}:'.format(entity_type)
+        names = sorted((i[len(prefix):].lower() if i.startswith(prefix) else i.lower(), i) for i in self.ids)
+        self._names = [name for name, _ in names]
+        self._named_ids = [i for _, i in names]
+
+    def __contains__(self, entity_id):
+        return entity_id in self._members
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, offset=0, limit=20):
+        """Return page of ids starting with the query and the number of all matching ids"""
+        if not query:
+            return self.ids[offset:offset + limit], len(self.ids)
+        if query.startswith('urn:'):
+            keys, values = self.ids, self.ids
+        else:
+            query = query.lower()
+            keys, values = self._names, self._named_ids
+        start = bisect_left(keys, query)
+        end = bisect_left(keys, query[:-1] + chr(ord(query[-1]) + 1), start)
+        return values[start + offset:min(start + offset + limit, end)], end - start
+
+
+class ChoiceProvider(object):
+    """Entity ids offered by the relationship fields of the device forms.
+
+    Ids of all requested entity types which are not cached yet are fetched from Orion in one
+    multi-type query and cached per type for ``ttl`` seconds as an ``IdIndex``. The cache is
+    cleared whenever entities are written through the Orion client.
+    """
+    ttl = 30
+    maxsize = 1024
+
+    def __init__(self, orion, config={}):
+        self.orion = orion
+        self.cache = TTLCache(ttl=config.get('ttl', self.ttl), maxsize=config.get('maxsize', self.maxsize),
+                              name='choices')
+        orion.add_write_listener(self.invalidate)
+
+    def get_indexes(self, types):
+        """Return dict of entity type -> IdIndex"""
+        indexes = {}
+        missing = []
+        for entity_type in sorted(set(types)):
+            cached = self.cache.get(entity_type)
+            if cached is None:
+                missing.append(entity_type)
+            else:
+                indexes[entity_type] = cached
+        if missing:
+            try:
+                fetched = self.fetch(missing)
+            except Exception as e:
+                logging.error('Could not fetch choices of {}: {}'.format(', '.join(missing), e))
+                fetched = {entity_type: IdIndex(entity_type, []) for entity_type in missing}
+            else:
+                for entity_type, index in fetched.items():
+                    self.cache.set(entity_type, index)
+            indexes.update(fetched)
+        return indexes
+
+    def get_ids(self, types):
+        """Return dict of entity type -> sorted list of entity ids"""
+        return {entity_type: index.ids for entity_type, index in self.get_indexes(types).items()}
+
+    def fetch(self, types):
+        """Fetch ids of all the types in one query"""
+        fetched = {entity_type: [] for entity_type in types}
+        for entity_id, entity_type in self.orion.iter_entity_ids(types):
+            if len(types) == 1:
+                entity_type = types[0]
+            if entity_type in fetched:
+                fetched[entity_type].append(entity_id)
+        return {entity_type: IdIndex(entity_type, ids) for entity_type, ids in fetched.items()}
+
+    def search(self, entity_type, query, offset=0, limit=20):
+        """Return page of ids of the type starting with the query and the number of all matching ids"""
+        return self.get_indexes([entity_type])[entity_type].search(query, offset, limit)
+
+    def contains(self, entity_type, entity_id):
+        """Check if entity of the type exists, asking Orion for ids created since the type was cached"""
+        if entity_id in self.get_indexes([entity_type])[entity_type]:
+            return True
+        if self.orion.entity_exists(entity_id, entity_type):
+            self.cache.pop(entity_type)
+            return True
+        return False
+
+    def invalidate(self):
+        self.cache.clear()
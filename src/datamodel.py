@@ -1,78 +1,257 @@
 import glob
 import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from collections.abc import Mapping
 from pathlib import Path
+from types import MappingProxyType
 
 import os
-from jinja2 import Environment, FileSystemLoader, meta
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateError, meta
+
+import metrics
+import timing
+
+Property = namedtuple('Property', ['order', 'name', 'property', 'optional', 'data_type', 'value'])
+Property.__new__.__defaults__ = (None,)
+
+
+class SchemaIndex(object):
+    """Index of the property schema of every NGSI-LD device type.
+
+    Templates are parsed once when the index is built. On lookup the template directory is polled for
+    changed modification times, at most every ``poll_interval`` seconds, and only the changed templates
+    and the device types extending them are indexed again. Lookups are counted as hits and schemas
+    built by the index as misses of the ``device_schemas`` cache metrics.
+    """
+    poll_interval = 2
+
+    def __init__(self, env, path, extension='.template', poll_interval=None):
+        self._env = env
+        self._path = path
+        self._extension = extension
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._mtimes = {}
+        self._parsed = {}
+        self._schemas = {}
+        self._checked_at = 0
+        self.device_types = []
+        self.reload()
+
+    def _scan(self):
+        """Return modification time of every template by its name relative to the template directory"""
+        files = {}
+        for root, dirs, names in os.walk(self._path):
+            for name in names:
+                if name.endswith(self._extension):
+                    filename = os.path.join(root, name)
+                    files[os.path.relpath(filename, self._path).replace(os.sep, '/')] = os.stat(filename).st_mtime
+        return files
+
+    def _parse(self, filename):
+        """Return templates referenced by the template and its own variables"""
+        source = self._env.loader.get_source(self._env, filename)[0]
+        parsed_content = self._env.parse(source)
+        return (tuple(t for t in meta.find_referenced_templates(parsed_content) if t is not None),
+                tuple(meta.find_undeclared_variables(parsed_content)))
+
+    def _references(self, filename):
+        references = set()
+        for template in self._parsed.get(filename, ((), ()))[0]:
+            if template not in references:
+                references.add(template)
+                references |= self._references(template)
+        return references
+
+    def variables(self, filename):
+        """Return variables of the template including the templates it extends"""
+        if filename not in self._parsed:
+            self._parsed[filename] = self._parse(filename)
+        references, own_variables = self._parsed[filename]
+        variables = []
+        for template in references:
+            variables.extend(self.variables(template))
+        variables.extend(own_variables)
+        return variables
+
+    def _build(self, device_type):
+        properties_dict = {}
+        for variable in self.variables(device_type):
+            splitted_property = variable.split('_')
+            key = splitted_property[0]
+            properties_dict[key] = Property(order=splitted_property[1],
+                                            name=splitted_property[2],
+                                            property=variable,
+                                            optional=splitted_property[4],
+                                            data_type=splitted_property[3])
+        return MappingProxyType(properties_dict)
+
+    def reload(self):
+        """Index new and changed templates, return True if anything changed"""
+        with self._lock:
+            self._checked_at = time.time()
+            files = self._scan()
+            changed = set(f for f, mtime in files.items() if self._mtimes.get(f) != mtime)
+            changed |= set(self._mtimes) - set(files)
+            if not changed:
+                return False
+
+            for filename in changed:
+                self._parsed.pop(filename, None)
+                if filename in files:
+                    try:
+                        self._parsed[filename] = self._parse(filename)
+                    except TemplateError as e:
+                        logging.error('Could not parse template {}: {}'.format(filename, e))
+
+            schemas = {}
+            for device_type in sorted(f for f in files if '/' not in f):
+                if device_type not in self._parsed:
+                    continue
+                dependencies = self._references(device_type) | {device_type}
+                if device_type in self._schemas and not dependencies & changed:
+                    schemas[device_type] = self._schemas[device_type]
+                    continue
+                metrics.record_cache('device_schemas', False)
+                try:
+                    schemas[device_type] = self._build(device_type)
+                except (TemplateError, IndexError) as e:
+                    logging.error('Could not index device type {}: {}'.format(device_type, e))
+            self._schemas = schemas
+            self._mtimes = files
+            self.device_types = sorted(schemas)
+            logging.info('Indexed device types {}'.format(', '.join(sorted(changed))))
+            return True
+
+    def check(self):
+        """Reload the index if the poll interval has passed"""
+        if time.time() - self._checked_at >= self.poll_interval:
+            self.reload()
+
+    def get(self, device_type):
+        """Return read-only mapping of property key to Property record of the device type"""
+        self.check()
+        schema = self._schemas[device_type]
+        metrics.record_cache('device_schemas', True)
+        return schema
+
+
+def freeze(value):
+    """Return read-only copy of parsed JSON, dicts become mapping proxies and lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Return mutable copy of a value created by freeze"""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
 
 
 class Datamodel(object):
     _ngsi2 = ''
     _ngsi_ld = ''
     _classes = ''
-    device_types = []
-    iotdevice_types = []
 
     def __init__(self, config):
         self._ngsi2 = config['ngsi2']
         self._ngsi_ld = config['ngsi-ld']
         self._classes = config['classes']
+        self._env = self.create_environment(config.get('bytecode_cache'))
+        self.schema = SchemaIndex(self._env, self._ngsi_ld, poll_interval=config.get('poll_interval'))
 
-        self.device_types = self.get_dir_list(self._ngsi_ld)
-        if self.device_types is not None and len(self.device_types) > 0:
-            self.device_types.sort()
-        self.iotdevice_types = self.get_dir_list(self._ngsi2, extension='.json')
-        if self.iotdevice_types is not None and len(self.iotdevice_types) > 0:
-            self.iotdevice_types.sort()
+        self._definitions = {}
+        self._iotdevice_types = ([], None)
+        self._class_entities = {}
         self.classes_file_list = self.get_classes_files()
         self.classes_list = self.get_classes()
 
+    def create_environment(self, bytecode_cache=None):
+        """Create Jinja environment for the NGSI-LD templates.
+
+        Compiled templates are kept in memory and reloaded when the file changes. Their bytecode is
+        stored on disk, in the bytecode_cache directory if given, so other workers can skip compiling.
+        """
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+            cache = FileSystemBytecodeCache(directory=bytecode_cache)
+        else:
+            cache = FileSystemBytecodeCache()
+        return Environment(loader=FileSystemLoader(searchpath=self._ngsi_ld), bytecode_cache=cache,
+                           auto_reload=True, cache_size=-1)
+
+    @property
+    @timing.timed('datamodel')
+    def device_types(self):
+        """Sorted list of NGSI-LD device templates"""
+        self.schema.check()
+        return self.schema.device_types
+
+    @timing.timed('datamodel')
     def get_variables(self, filename):
-        variables = []
-        env = Environment(loader=FileSystemLoader(searchpath=self._ngsi_ld))
-
-        template_source = env.loader.get_source(env, filename)[0]
-        parsed_content = env.parse(template_source)
-        templates = list(meta.find_referenced_templates(parsed_content))
-        if len(templates) > 0:
-            for template in templates:
-                for variable in self.get_variables(template):
-                    variables.append(variable)
-        for variable in meta.find_undeclared_variables(parsed_content):
-            variables.append(variable)
-        return variables
+        return self.schema.variables(filename)
 
+    @timing.timed('datamodel')
     def create_entity(self, device_type, properties):
-        env = Environment(loader=FileSystemLoader(searchpath=self._ngsi_ld))
-        template = env.get_template(device_type)
+        template = self._env.get_template(device_type)
         return template.render(properties)
 
+    @timing.timed('datamodel')
     def get_properties_dict(self, device_type):
-        variables = self.get_variables(device_type)
+        """Return property schema of the device type from the index"""
+        return self.schema.get(device_type)
 
-        # Get all properties from Data Model template itself
-        properties_dict = {}
-        for property in variables:
-            splitted_property = property.split('_')
-            key = splitted_property[0]
-            order = splitted_property[1]
-            name = splitted_property[2]
-            data_type = splitted_property[3]
-            optional = splitted_property[4]
-            properties_dict[key] = (order, name, property, optional, data_type, None,)
+    @property
+    @timing.timed('datamodel')
+    def iotdevice_types(self):
+        """Sorted list of NGSI2 device definitions, listed again when the directory changes"""
+        types, mtime = self._iotdevice_types
+        current = os.stat(self._ngsi2).st_mtime
+        if current != mtime:
+            types = sorted(self.get_dir_list(self._ngsi2, extension='.json'))
+            self._iotdevice_types = (types, current)
+        return types
 
-        return properties_dict
+    @timing.timed('datamodel')
+    def get_iotdevice_definition(self, device_type):
+        """Return read-only definition of the NGSI2 device type merged with its base template.
 
-    def create_iotdevice_from_json(self, device_type):
+        Merged definitions are cached and built again when the type or base file changes.
+        """
+        entry = self._definitions.get(device_type)
+        if entry is not None:
+            files, mtimes, definition = entry
+            try:
+                if tuple(os.stat(f).st_mtime for f in files) == mtimes:
+                    metrics.record_cache('iotdevice_definitions', True)
+                    return definition
+            except OSError:
+                pass
+        metrics.record_cache('iotdevice_definitions', False)
+
+        files = ['{}/{}'.format(self._ngsi2, device_type)]
+        mtimes = [os.stat(files[0]).st_mtime]
         device = {}
 
-        with open('{}/{}'.format(self._ngsi2, device_type), 'rt') as f:
+        with open(files[0], 'rt') as f:
             device_by_type = json.load(f)
             for key, value in device_by_type.items():
                 device[key] = value
 
         if 'base_template' in device:
-            with open('{}/{}'.format(self._ngsi2, device['base_template']), 'rt') as f:
+            files.append('{}/{}'.format(self._ngsi2, device['base_template']))
+            mtimes.append(os.stat(files[1]).st_mtime)
+            with open(files[1], 'rt') as f:
                 device_base = json.load(f)
                 for key, value in device_base.items():
                     if key in device and type(value) == list:
@@ -82,7 +261,13 @@ class Datamodel(object):
 
         device.pop('base_template', None)
 
-        return device
+        definition = freeze(device)
+        self._definitions[device_type] = (tuple(files), tuple(mtimes), definition)
+        return definition
+
+    def create_iotdevice_from_json(self, device_type):
+        """Return mutable copy of the merged definition of the NGSI2 device type"""
+        return thaw(self.get_iotdevice_definition(device_type))
 
     def get_dir_list(self, datamodel_path, extension='.template'):
         return [f for f in os.listdir(datamodel_path) if os.path.isfile(os.path.join(datamodel_path, f)) and Path(
@@ -91,5 +276,27 @@ class Datamodel(object):
     def get_classes_files(self):
         return glob.glob('{}/*/*.jsonld'.format(self._classes))
 
+    @timing.timed('datamodel')
+    def get_class_entities(self):
+        """Return entities of the class files, a file is read again only when it has changed"""
+        entities = []
+        loaded = {}
+        for path in sorted(self.get_classes_files()):
+            try:
+                mtime = os.stat(path).st_mtime
+                entry = self._class_entities.get(path)
+                hit = entry is not None and entry[0] == mtime
+                metrics.record_cache('class_entities', hit)
+                if not hit:
+                    with open(path, 'rt') as f:
+                        entry = (mtime, json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error('Could not load class {}: {}'.format(path, e))
+                continue
+            loaded[path] = entry
+            entities.append(entry[1])
+        self._class_entities = loaded
+        return entities
+
     def get_classes(self):
         return [f for f in os.listdir(self._classes) if os.path.isdir(os.path.join(self._classes, f))]
@@ -0,0 +1,84 @@
+import re
+from collections import deque
+
+
+class DataTablesQuery(object):
+    """Server-side processing request of the DataTables plugin.
+
+    Upstreams return items in their natural (registration) order only, so the table can be ordered
+    ascending or descending by that order. The descending window is read from the end of the list.
+    Upstreams which cannot search are scanned for at most ``max_scan`` items, the response is then
+    flagged as partial.
+    """
+    max_length = 1000
+    max_scan = 2000
+
+    def __init__(self, args):
+        self.draw = self._int(args.get('draw'), 0)
+        self.start = max(self._int(args.get('start'), 0), 0)
+        self.length = self._int(args.get('length'), 10)
+        if self.length < 0 or self.length > self.max_length:
+            self.length = self.max_length
+        self.search = args.get('search[value]', '').strip()
+        self.order_dir = 'desc' if args.get('order[0][dir]') == 'desc' else 'asc'
+
+    @staticmethod
+    def _int(value, default):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    @property
+    def id_pattern(self):
+        """Regular expression matching ids which contain the search value"""
+        if self.search:
+            return '.*{}.*'.format(re.escape(self.search))
+        return None
+
+    def matches(self, *values):
+        """Check if any of the values contains the search value"""
+        search = self.search.lower()
+        return any(search in str(value).lower() for value in values)
+
+    def fetch(self, get_page):
+        """Fetch the requested window via get_page(offset, limit) returning (items, total)"""
+        if self.order_dir == 'asc':
+            return get_page(self.start, self.length)
+        total = get_page(0, 1)[1]
+        end = total - self.start
+        if end <= 0:
+            return [], total
+        offset = max(end - self.length, 0)
+        items, total = get_page(offset, end - offset)
+        return list(reversed(items)), total
+
+    def filter(self, items, predicate):
+        """Select the requested window of matching items from an iterator and count all matches"""
+        matched = 0
+        if self.order_dir == 'asc':
+            window = []
+            for item in items:
+                if predicate(item):
+                    if self.start <= matched < self.start + self.length:
+                        window.append(item)
+                    matched += 1
+            return window, matched
+
+        tail = deque(maxlen=self.start + self.length)
+        for item in items:
+            if predicate(item):
+                tail.append(item)
+                matched += 1
+        return list(reversed(tail))[self.start:], matched
+
+    def response(self, data, total, filtered=None, partial=False):
+        response = {
+            'draw': self.draw,
+            'recordsTotal': total,
+            'recordsFiltered': total if filtered is None else filtered,
+            'data': data
+        }
+        if partial:
+            response['partial'] = True
+        return response
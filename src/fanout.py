@@ -0,0 +1,60 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import os
+
+import timing
+
+
+class FanOut(object):
+    """Run independent upstream calls concurrently on a bounded worker pool.
+
+    The pool is shared by all requests of a worker process and created lazily, so it is not
+    inherited by forked uwsgi workers. Calls which do not finish before the deadline or fail are
+    reported as missing, the caller renders whatever has arrived.
+    """
+    max_workers = 8
+    deadline = 10
+
+    def __init__(self, config={}):
+        self.max_workers = config.get('max_workers', self.max_workers)
+        self.deadline = config.get('deadline', self.deadline)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='fanout')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        return self.executor.submit(timing.bind(func), *args, **kwargs)
+
+    def run(self, calls, deadline=None):
+        """Run dict of name -> callable and return tuple of results dict and list of missing names"""
+        if deadline is None:
+            deadline = self.deadline
+        futures = {self.executor.submit(timing.bind(func)): name for name, func in calls.items()}
+        done, not_done = wait(futures, timeout=deadline)
+
+        results = {}
+        missing = []
+        for future in done:
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error('Call {} failed: {}'.format(name, e))
+                missing.append(name)
+        for future in not_done:
+            future.cancel()
+            logging.warning('Call {} did not finish in {} seconds'.format(futures[future], deadline))
+            missing.append(futures[future])
+        return results, missing
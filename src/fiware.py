@@ -1,32 +1,109 @@
 import json
 import logging
+import re
 
 import hashlib
 import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+
+import metrics
 
 logging.basicConfig(level=logging.DEBUG)
 
 
 class BaseRequest(object):
-    # def get(self, url, data, headers):
-    #     e = None
-    #     result = {}
-    #     try:
-    #         r = requests.get(url, headers=headers, timeout=60)
-    #         result = r.json()
-    #         r.raise_for_status()
-    #     except requests.exceptions.RequestException as err:
-    #         e = err
-    #         logging.error("Error", err)
-    #     if e is None:
-    #         return {'status': True, "result": result}
-    #     else:
-    #         return {'status': False, 'error': e}
+    """Common HTTP layer for the FIWARE clients.
+
+    Every client talks to its upstream through a pooled keep-alive session which is shared between
+    all instances and threads pointing to the same service. Pool size and timeout can be configured
+    in the ``http`` section of the ``fiware`` config block, globally or per client, e.g.
+    ``{"http": {"pool_maxsize": 10, "orion": {"pool_maxsize": 20, "timeout": 30}}}``.
+    """
+    name = 'base'
+    url = ''
+    timeout = 60
+    pool_connections = 4
+    pool_maxsize = 10
+    max_retries = 0
+    page_size = 100
+    batch_size = 100
+
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def configure_session(self, config):
+        """Read session and paging settings for this client from the fiware config block"""
+        self.page_size = config.get('page_size', self.page_size)
+        self.batch_size = config.get('batch_size', self.batch_size)
+        http = dict(config.get('http', {}))
+        settings = {key: value for key, value in http.items() if not isinstance(value, dict)}
+        settings.update(http.get(self.name, {}))
+        self.timeout = settings.get('timeout', self.timeout)
+        self.pool_connections = settings.get('pool_connections', self.pool_connections)
+        self.pool_maxsize = settings.get('pool_maxsize', self.pool_maxsize)
+        self.max_retries = settings.get('max_retries', self.max_retries)
+
+    @property
+    def session(self):
+        """Return the shared session for the upstream of this client"""
+        key = (self.name, self.url)
+        session = BaseRequest._sessions.get(key)
+        if session is None:
+            with BaseRequest._sessions_lock:
+                session = BaseRequest._sessions.get(key)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                          pool_maxsize=self.pool_maxsize,
+                                          max_retries=self.max_retries)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    BaseRequest._sessions[key] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        """Perform HTTP request to the upstream using the shared session, record its latency and errors"""
+        kwargs.setdefault('timeout', self.timeout)
+        operation = metrics.current_operation()
+        in_flight = metrics.UPSTREAM_IN_FLIGHT.labels(self.name)
+        status = 'error'
+        start = time.time()
+        in_flight.inc()
+        try:
+            r = self.session.request(method, url, **kwargs)
+            status = metrics.status_class(r.status_code)
+            return r
+        finally:
+            in_flight.dec()
+            metrics.UPSTREAM_LATENCY.labels(self.name, operation, method, status).observe(time.time() - start)
+            if status in ('error', '5xx'):
+                metrics.UPSTREAM_ERRORS.labels(self.name, operation).inc()
+
+    def iter_pages(self, get_page, offset=0, page_size=None, max_items=None):
+        """Iterate over items returned by get_page(offset, limit) fetching one page at a time"""
+        page_size = page_size or self.page_size
+        fetched = 0
+        while max_items is None or fetched < max_items:
+            limit = page_size if max_items is None else min(page_size, max_items - fetched)
+            items = get_page(offset + fetched, limit)
+            for item in items:
+                yield item
+            fetched += len(items)
+            if len(items) < limit:
+                break
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request('GET', url, headers=headers, **kwargs)
+
+    def delete(self, url, headers=None, **kwargs):
+        return self.request('DELETE', url, headers=headers, **kwargs)
 
     def post(self, url, data, headers):
         e = None
         try:
-            r = requests.post(url, data=data, headers=headers, timeout=60)
+            r = self.request('POST', url, data=data, headers=headers)
             r.raise_for_status()
         except requests.exceptions.RequestException as err:
             e = err
@@ -37,8 +114,10 @@ class BaseRequest(object):
             return {'status': False, 'error': e}
 
 
+@metrics.instrument
 class Orion(BaseRequest):
     """Class wrapper for Fiware Orion service"""
+    name = 'orion'
     url = 'http://orion:1026'
     header = {''}
     headers_ld = {'Content-type': 'application/ld+json'}
@@ -48,47 +127,213 @@ class Orion(BaseRequest):
         'Content-type': 'application/ld+json',
         'Link': '<http://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld>; rel="http://www.w3.org/ns/json-ld#context"; type="application/ld+json"'}
 
+    pick_supported = True
+    uninstrumented = ('add_write_listener', 'notify_write')
+
     def __init__(self, config={}):
         try:
             self.url = config['orion']
         except Exception as e:
             logging.error('Init orion', e)
+        self.configure_session(config)
+        self._write_listeners = []
+
+    def add_write_listener(self, listener):
+        """Register callable which is called after entities were written through this client"""
+        self._write_listeners.append(listener)
+
+    def notify_write(self):
+        for listener in self._write_listeners:
+            try:
+                listener()
+            except Exception as e:
+                logging.error('Write listener failed: {}'.format(e))
 
     def create_entity(self, data):
         """Create entity via REST API call to FIWARE Orion instance"""
         url = '{}/ngsi-ld/v1/entities'.format(self.url)
-        return self.post(url, data=data, headers=self.headers_ld)
+        result = self.post(url, data=data, headers=self.headers_ld)
+        self.notify_write()
+        return result
 
     def update_entity(self, device_id, data):
         """Create entity via REST API call to FIWARE Orion instance"""
         url = '{}/ngsi-ld/v1/entities/{}/attrs'.format(self.url, device_id)
-        return self.post(url, data=data, headers=self.headers_ld)
-
-    def get_entities(self, type, offset=0, limit=20):
-        """Get list of entities from FIWARE Orion instance"""
-        # url = '{}/ngsi-ld/v1/entities?type={}&offset={}&limit={}'.format(self.url, type, offset, limit)
-        url = '{}/ngsi-ld/v1/entities?type={}'.format(self.url, type, offset, limit)
-        r = requests.get(url, headers=self.headers_with_link)
-        return r.json()
+        result = self.post(url, data=data, headers=self.headers_ld)
+        self.notify_write()
+        return result
+
+    def batch_create(self, entities, batch_size=None, upsert=False):
+        """Create entities via NGSI-LD entity operations, ``batch_size`` entities per request.
+
+        Existing entities are skipped and reported as ``exists``, or replaced and reported as
+        ``updated`` if upsert is set, so the call can be repeated. Returns list of dicts with id,
+        status (created, exists, updated or failed) and error of every entity.
+        """
+        operation = 'upsert' if upsert else 'create'
+        url = '{}/ngsi-ld/v1/entityOperations/{}'.format(self.url, operation)
+        batch_size = batch_size or self.batch_size
+        report = []
+        for start in range(0, len(entities), batch_size):
+            batch = entities[start:start + batch_size]
+            ids = [entity.get('id') for entity in batch]
+            try:
+                r = self.request('POST', url, data=json.dumps(batch), headers=self.headers_ld)
+            except requests.exceptions.RequestException as e:
+                logging.error('Batch {} failed: {}'.format(operation, e))
+                report.extend({'id': i, 'status': 'failed', 'error': str(e)} for i in ids)
+                continue
+            report.extend(self._batch_report(ids, r, 'updated' if upsert else 'created'))
+        if entities:
+            self.notify_write()
+        return report
+
+    def batch_delete(self, ids, batch_size=None):
+        """Delete entities via NGSI-LD entity operations, ``batch_size`` ids per request.
+
+        Returns list of dicts with id, status (deleted, not_found or failed) and error of every id.
+        """
+        url = '{}/ngsi-ld/v1/entityOperations/delete'.format(self.url)
+        batch_size = batch_size or self.batch_size
+        report = []
+        for start in range(0, len(ids), batch_size):
+            batch = list(ids[start:start + batch_size])
+            try:
+                r = self.request('POST', url, data=json.dumps(batch), headers=self.headers_ld)
+            except requests.exceptions.RequestException as e:
+                logging.error('Batch delete failed: {}'.format(e))
+                report.extend({'id': i, 'status': 'failed', 'error': str(e)} for i in batch)
+                continue
+            report.extend(self._batch_report(batch, r, 'deleted'))
+        if ids:
+            self.notify_write()
+        return report
+
+    @staticmethod
+    def _batch_report(ids, r, success):
+        """Turn response of an entity operation into per-entity results"""
+        if r.status_code in (201, 204):
+            return [{'id': i, 'status': success, 'error': None} for i in ids]
+        try:
+            body = r.json()
+        except ValueError:
+            body = None
+        if r.status_code != 207 or not isinstance(body, dict):
+            error = body.get('title', r.text) if isinstance(body, dict) else r.text
+            return [{'id': i, 'status': 'failed', 'error': error or str(r.status_code)} for i in ids]
+
+        results = {i: {'id': i, 'status': success, 'error': None} for i in body.get('success', [])}
+        for item in body.get('errors', []):
+            error = item.get('error', {})
+            error_type = str(error.get('type', ''))
+            if error.get('status') == 409 or error_type.endswith('AlreadyExists'):
+                results[item.get('entityId')] = {'id': item.get('entityId'), 'status': 'exists', 'error': None}
+            elif error.get('status') == 404 or error_type.endswith('ResourceNotFound'):
+                results[item.get('entityId')] = {'id': item.get('entityId'), 'status': 'not_found', 'error': None}
+            else:
+                results[item.get('entityId')] = {'id': item.get('entityId'), 'status': 'failed',
+                                                  'error': error.get('detail') or error.get('title')}
+        return [results.get(i, {'id': i, 'status': 'failed', 'error': 'No result'}) for i in ids]
+
+    def get_entities(self, type, offset=0, limit=None):
+        """Get list of entities from FIWARE Orion instance, all of them if limit is not set"""
+        if limit is None:
+            return list(self.iter_entities(type, offset=offset))
+        return self.get_entities_page(type, offset, limit, count=False)[0]
+
+    def get_entities_page(self, type, offset=0, limit=None, count=True, id_pattern=None):
+        """Get one page of entities together with the total number of entities of the type"""
+        url = '{}/ngsi-ld/v1/entities'.format(self.url)
+        params = {'type': type, 'offset': offset, 'limit': limit or self.page_size}
+        if count:
+            params['count'] = 'true'
+        if id_pattern is not None:
+            params['idPattern'] = id_pattern
+        r = self.get(url, headers=self.headers_with_link, params=params)
+        r.raise_for_status()
+        total = r.headers.get('NGSILD-Results-Count')
+        return r.json(), int(total) if total is not None else None
+
+    def iter_entities(self, type, offset=0, page_size=None, max_items=None):
+        """Iterate over entities of the type fetching one page of the broker at a time"""
+        def get_page(offset, limit):
+            return self.get_entities_page(type, offset, limit, count=False)[0]
+        return self.iter_pages(get_page, offset, page_size, max_items)
+
+    def count_entities(self, type, id_pattern=None):
+        """Get number of entities of the type without transferring them"""
+        return self.count_entities_by_types([type], id_pattern)
+
+    def count_entities_by_types(self, types, id_pattern=None):
+        """Get total number of entities of the given types in one request without transferring them"""
+        url = '{}/ngsi-ld/v1/entities'.format(self.url)
+        params = {'type': ','.join(types), 'count': 'true', 'limit': 0}
+        if id_pattern is not None:
+            params['idPattern'] = id_pattern
+        r = self.get(url, headers=self.headers_with_link, params=params)
+        r.raise_for_status()
+        return int(r.headers['NGSILD-Results-Count'])
+
+    def get_entity_ids_page(self, types, offset=0, limit=None):
+        """Get one page of (id, type) pairs of entities of the given types in one request.
+
+        Only id and type are projected by the broker (``pick``); if the broker rejects the parameter,
+        this client asks it for key-values of the whole entities instead.
+        """
+        url = '{}/ngsi-ld/v1/entities'.format(self.url)
+        params = {'type': ','.join(types), 'offset': offset, 'limit': limit or self.page_size,
+                  'options': 'keyValues'}
+        if self.pick_supported:
+            params['pick'] = 'id,type'
+        r = self.get(url, headers=self.headers_with_link, params=params)
+        if r.status_code == 400 and self.pick_supported and 'pick' in r.text:
+            logging.warning('Orion does not support pick, requesting whole entities')
+            self.pick_supported = False
+            return self.get_entity_ids_page(types, offset, limit)
+        r.raise_for_status()
+        return [(entity['id'], entity.get('type')) for entity in r.json()]
+
+    def iter_entity_ids(self, types, page_size=None):
+        """Iterate over (id, type) pairs of entities of the given types"""
+        def get_page(offset, limit):
+            return self.get_entity_ids_page(types, offset, limit)
+        return self.iter_pages(get_page, 0, page_size)
 
     def get_entity_by_id(self, id):
         """Get entity from FIWARE Orion instance"""
         # url = '{}/ngsi-ld/v1/entities?type={}&offset={}&limit={}'.format(self.url, type, offset, limit)
         url = '{}/ngsi-ld/v1/entities/{}'.format(self.url, id)
-        r = requests.get(url, headers=self.headers_ld)
+        r = self.get(url, headers=self.headers_ld)
         return r.json()
 
+    def entity_exists(self, id, type=None):
+        """Check if entity with the id, and of the type if given, exists in FIWARE Orion instance"""
+        if type is not None:
+            url = '{}/ngsi-ld/v1/entities'.format(self.url)
+            params = {'type': type, 'idPattern': '^{}$'.format(re.escape(id)), 'count': 'true', 'limit': 0}
+            r = self.get(url, headers=self.headers_with_link, params=params)
+            return r.status_code == 200 and int(r.headers.get('NGSILD-Results-Count', 0)) > 0
+        url = '{}/ngsi-ld/v1/entities/{}'.format(self.url, id)
+        r = self.get(url, headers=self.headers_with_link, params={'options': 'keyValues'})
+        return r.status_code == 200
+
     def delete_entity(self, device_id):
         """Remove device from the orion"""
         url = '{}/ngsi-ld/v1/entities/{}'.format(self.url, device_id)
-        r = requests.delete(url, headers=self.headers_ld)
+        r = self.delete(url, headers=self.headers_ld)
+        self.notify_write()
         return r
 
+    @staticmethod
+    def get_subscription_pattern(device_type):
+        """Return id pattern of the entities the QuantumLeap subscription of the device type is for"""
+        return "urn:ngsi-ld:{}:*".format(device_type.split('.')[0])
+
     def create_subscription(self, device_type):
         """Create a subscription within Orion"""
         url = '{}/v2/subscriptions'.format(self.url)
+        device_pattern = self.get_subscription_pattern(device_type)
         device_type = device_type.split('.')[0]
-        device_pattern = "urn:ngsi-ld:{}:*".format(device_type)
         description = "Notify QuantumLeap with {}".format(device_type)
         data = {
             "description": description,
@@ -111,24 +356,44 @@ class Orion(BaseRequest):
 
     def get_subscriptions(self):
         """"Get list of subscriptions"""
+        return list(self.iter_subscriptions())
+
+    def get_subscriptions_page(self, offset=0, limit=None):
+        """Get one page of subscriptions together with the total number of subscriptions"""
         url = '{}/v2/subscriptions'.format(self.url)
-        r = requests.get(url, headers=self.headers_v2)
-        return r.json()
+        params = {'offset': offset, 'limit': limit or self.page_size, 'options': 'count'}
+        r = self.get(url, headers=self.headers_v2, params=params)
+        r.raise_for_status()
+        total = r.headers.get('Fiware-Total-Count')
+        return r.json(), int(total) if total is not None else None
+
+    def iter_subscriptions(self, offset=0, page_size=None, max_items=None):
+        """Iterate over subscriptions fetching one page of the broker at a time"""
+        def get_page(offset, limit):
+            return self.get_subscriptions_page(offset, limit)[0]
+        return self.iter_pages(get_page, offset, page_size, max_items)
+
+    def count_subscriptions(self):
+        """Get number of subscriptions without transferring them"""
+        url = '{}/v2/subscriptions'.format(self.url)
+        r = self.get(url, headers=self.headers_v2, params={'limit': 1, 'options': 'count'})
+        r.raise_for_status()
+        return int(r.headers['Fiware-Total-Count'])
 
     def delete_subscription(self, subscription_id):
         """"Get list of subscriptions"""
         url = '{}/v2/subscriptions/{}'.format(self.url, subscription_id)
         print(url)
-        r = requests.delete(url, headers=self.headers_v2)
+        r = self.delete(url, headers=self.headers_v2)
         if r.status_code == 204:
             return 'success'
         return r.json()
 
-    def get_version(self):
+    def get_version(self, timeout=None):
         """Return version of Orion"""
         url = '{}/version'.format(self.url)
         try:
-            r = requests.get(url)
+            r = self.get(url, timeout=timeout or self.timeout)
             if r.status_code == 200:
                 return r.json()['orionld version']
         except Exception as e:
@@ -136,10 +401,18 @@ class Orion(BaseRequest):
         return ''
 
 
+@metrics.instrument
 class IoTAgent(BaseRequest):
-    """Class wrapper for Fiware IoT Agent service"""
+    """Class wrapper for Fiware IoT Agent service.
+
+    Services of the default FIWARE service are kept in a registry indexed by apikey. It is loaded
+    on first use, updated by create_service and delete_service and loaded again after
+    ``services_ttl`` seconds, so services changed by other workers show up eventually.
+    """
+    name = 'iotagent'
     url = 'http://iot-agent:4041'
     headers = {'Content-type': 'application/json', 'fiware-service': 'openiot', 'fiware-servicepath': '/'}
+    services_ttl = 300
 
     def __init__(self, config={}):
         try:
@@ -147,6 +420,44 @@ class IoTAgent(BaseRequest):
             self.orion = config['orion']
         except Exception as e:
             logging.error('Init iotgent', e)
+        self.configure_session(config)
+        self.services_ttl = config.get('services_ttl', self.services_ttl)
+        self._services = None
+        self._services_loaded_at = 0
+        self._services_lock = threading.Lock()
+
+    def _service_registry(self):
+        """Return dict of apikey -> service, load it from the IoT Agent if it is missing or expired"""
+        services = self._services
+        if services is not None and time.time() - self._services_loaded_at < self.services_ttl:
+            metrics.record_cache('iotagent_services', True)
+            return services
+        metrics.record_cache('iotagent_services', False)
+        with self._services_lock:
+            if self._services is None or time.time() - self._services_loaded_at >= self.services_ttl:
+                self._services = {service['apikey']: service for service in self.iter_services()}
+                self._services_loaded_at = time.time()
+            return self._services
+
+    def get_service(self, apikey):
+        """Return registered service with the apikey or None"""
+        return self._service_registry().get(apikey)
+
+    def ensure_service(self, apikey, device_type):
+        """Create service for the device type unless it is registered.
+
+        A service created meanwhile by another worker is rejected by the IoT Agent as duplicate,
+        which counts as success.
+        """
+        if self.get_service(apikey) is not None:
+            return {'status': True}
+        result = self.create_service(apikey, device_type)
+        if not result['status']:
+            response = getattr(result['error'], 'response', None)
+            if response is not None and response.status_code == 409:
+                self._services[apikey] = {'apikey': apikey, 'entity_type': device_type.split('.')[0]}
+                return {'status': True}
+        return result
 
     def _hash(self, type):
         m = hashlib.md5()
@@ -167,17 +478,49 @@ class IoTAgent(BaseRequest):
                 "timezone": "Europe/Berlin"
             }
         ]}
-        return self.post(url, data=json.dumps(data), headers=self.headers)
-
-    def get_services(self):
+        result = self.post(url, data=json.dumps(data), headers=self.headers)
+        if result['status'] and self._services is not None:
+            self._services[api_key] = data['services'][0]
+        return result
+
+    def _service_headers(self, service=None, service_path=None):
+        """Return headers addressing the given FIWARE service, the default one if not set"""
+        headers = dict(self.headers)
+        if service is not None:
+            headers['fiware-service'] = service
+        if service_path is not None:
+            headers['fiware-servicepath'] = service_path
+        return headers
+
+    def get_services(self, offset=0, limit=None, service=None, service_path=None):
+        """Get services of the IoT Agent, all of them if limit is not set"""
+        if limit is None:
+            services = list(self.iter_services(offset=offset, service=service, service_path=service_path))
+            return {'count': len(services), 'services': services}
+        services, count = self.get_services_page(offset, limit, service, service_path)
+        return {'count': count, 'services': services}
+
+    def get_services_page(self, offset=0, limit=None, service=None, service_path=None):
+        """Get one page of services together with the total number of services"""
         url = '{}/iot/services'.format(self.url)
-        r = requests.get(url, headers=self.headers)
-        return r.json()
+        params = {'offset': offset, 'limit': limit or self.page_size}
+        r = self.get(url, headers=self._service_headers(service, service_path), params=params)
+        r.raise_for_status()
+        data = r.json()
+        return data.get('services', []), data.get('count')
+
+    def iter_services(self, offset=0, service=None, service_path=None, page_size=None, max_items=None):
+        """Iterate over services fetching one page of the IoT Agent at a time"""
+        def get_page(offset, limit):
+            return self.get_services_page(offset, limit, service, service_path)[0]
+        return self.iter_pages(get_page, offset, page_size, max_items)
 
     def delete_service(self, apikey, resource):
         """Remove device from the IoT Agent"""
         url = '{}/iot/services/?apikey={}&resource={}'.format(self.url, apikey, resource)
-        r = requests.delete(url, headers=self.headers)
+        r = self.delete(url, headers=self.headers)
+        if r.status_code in (204, 404) and self._services is not None:
+            self._services.pop(apikey, None)
         return r
 
     def create_device(self, device_dict):
@@ -186,29 +529,83 @@ class IoTAgent(BaseRequest):
         url = '{}/iot/devices'.format(self.url)
         return self.post(url, data=json.dumps(devices), headers=self.headers)
 
-    def get_entities(self, offset=0, limit=20):
-        """Get list of entities from FIWARE IoT Agent instance"""
-        url = '{}/iot/devices'.format(self.url, offset, limit)
-        r = requests.get(url, headers=self.headers)
-        return r.json()
+    def create_devices(self, devices):
+        """Provision several devices in one request, return the response of the IoT Agent"""
+        url = '{}/iot/devices'.format(self.url)
+        return self.request('POST', url, data=json.dumps({'devices': devices}), headers=self.headers)
+
+    def get_entities(self, offset=0, limit=None, entity_type=None, service=None, service_path=None):
+        """Get list of entities from FIWARE IoT Agent instance, all of them if limit is not set.
+
+        ``count`` is the number of all devices (of the entity type if given), not only of the page.
+        With an entity type the pages of the IoT Agent are only walked until the page is full, the
+        count is then None (unknown); it is only known if fewer devices than limit matched.
+        """
+        if limit is not None and entity_type is None:
+            devices, count = self.get_devices_page(offset, limit, service, service_path)
+            return {'count': count, 'devices': devices}
+        devices = []
+        count = 0
+        for device in self.iter_devices(entity_type, service=service, service_path=service_path):
+            count += 1
+            if count <= offset:
+                continue
+            devices.append(device)
+            if limit is not None and len(devices) == limit:
+                return {'count': None, 'devices': devices}
+        return {'count': count, 'devices': devices}
+
+    def get_devices_page(self, offset=0, limit=None, service=None, service_path=None):
+        """Get one page of devices together with the total number of devices of the service"""
+        url = '{}/iot/devices'.format(self.url)
+        params = {'offset': offset, 'limit': limit or self.page_size}
+        r = self.get(url, headers=self._service_headers(service, service_path), params=params)
+        r.raise_for_status()
+        data = r.json()
+        return data.get('devices', []), data.get('count')
+
+    def iter_devices(self, entity_type=None, offset=0, service=None, service_path=None, page_size=None,
+                     max_items=None):
+        """Iterate over devices of the service fetching one page of the IoT Agent at a time.
+
+        The IoT Agent does not filter devices by entity type, so devices of other types are skipped
+        while the pages are walked and offset and max_items refer to the matching devices.
+        """
+        if entity_type is None:
+            def get_page(offset, limit):
+                return self.get_devices_page(offset, limit, service, service_path)[0]
+            for device in self.iter_pages(get_page, offset, page_size, max_items):
+                yield device
+            return
+
+        matched = 0
+        for device in self.iter_devices(service=service, service_path=service_path, page_size=page_size):
+            if device.get('entity_type') != entity_type:
+                continue
+            matched += 1
+            if matched <= offset:
+                continue
+            yield device
+            if max_items is not None and matched - offset >= max_items:
+                return
 
     def get_entity_by_id(self, id):
         """Get entity from FIWARE IoTAgent instance"""
         url = '{}/iot/devices/{}'.format(self.url, id)
-        r = requests.get(url, headers=self.headers)
+        r = self.get(url, headers=self.headers)
         return r.json()
 
     def delete_entity(self, device_id):
         """Remove device from the IoT Agent"""
         url = '{}/iot/devices/{}'.format(self.url, device_id)
-        r = requests.delete(url, headers=self.headers)
+        r = self.delete(url, headers=self.headers)
         return r
 
-    def get_version(self):
+    def get_version(self, timeout=None):
         """Return version of IoT Agent"""
         url = '{}/version'.format(self.url)
         try:
-            r = requests.get(url)
+            r = self.get(url, timeout=timeout or self.timeout)
             if r.status_code == 200:
                 return r.json()['version']
         except Exception as e:
@@ -216,8 +613,10 @@ class IoTAgent(BaseRequest):
         return ''
 
 
+@metrics.instrument
 class QuantumLeap(BaseRequest):
     """Class wrapper for Fiware IoT Agent service"""
+    name = 'quantumleap'
     url = 'http://iot-agent:4041'
     headers = {'Content-type': 'application/json', 'fiware-service': 'openiot', 'fiware-servicepath': '/'}
 
@@ -226,12 +625,13 @@ class QuantumLeap(BaseRequest):
             self.url = config['quantumleap']
         except Exception as e:
             logging.error('Init iotgent', e)
+        self.configure_session(config)
 
-    def get_version(self):
+    def get_version(self, timeout=None):
         """Return version of IoT Agent"""
         url = '{}/v2/version'.format(self.url)
         try:
-            r = requests.get(url)
+            r = self.get(url, timeout=timeout or self.timeout)
             if r.status_code == 200:
                 return r.json()['version']
         except Exception as e:
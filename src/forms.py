@@ -1,7 +1,17 @@
 import json
+import threading
+from collections.abc import Mapping
 from datetime import datetime
+from functools import partial
+from urllib.parse import urlencode
 
+from markupsafe import Markup, escape
 from wtforms import Form, DateTimeField, StringField, validators, SelectField, HiddenField
+from wtforms.widgets import TextInput
+
+from choices import ChoiceProvider
+import metrics
+import timing
 
 
 class TypesForm(Form):
@@ -9,13 +19,76 @@ class TypesForm(Form):
     types = SelectField(u'Type', id='select_type')
 
 
+class SearchInput(TextInput):
+    """Text input with a datalist of suggestions which is refilled from the search endpoint as the user types"""
+
+    def __call__(self, field, **kwargs):
+        options_id = '{}-options'.format(field.id)
+        kwargs.setdefault('list', options_id)
+        kwargs.setdefault('autocomplete', 'off')
+        kwargs['data-search'] = field.search_url
+        options = ''.join('<option value="{}">'.format(escape(i)) for i in field.suggestions())
+        return Markup('{}<datalist id="{}">{}</datalist>'.format(
+            super(SearchInput, self).__call__(field, **kwargs), options_id, options))
+
+
+class SearchField(StringField):
+    """Relationship field holding id of an entity of the given type.
+
+    Instead of an option for each entity the field suggests the first ``suggestions_size`` ids and
+    searches the others via ``/orion/search``, so the page size does not depend on the number of
+    entities. The value is validated against the choice provider bound to the form.
+    """
+    widget = SearchInput()
+    suggestions_size = 20
+
+    def __init__(self, label=None, validators=None, entity_type=None, **kwargs):
+        super(SearchField, self).__init__(label, validators, **kwargs)
+        self.entity_type = entity_type
+        self.provider = None
+
+    @property
+    def search_url(self):
+        return '/orion/search?{}'.format(urlencode({'type': self.entity_type}))
+
+    def suggestions(self):
+        if self.provider is None:
+            return []
+        return self.provider.search(self.entity_type, '', 0, self.suggestions_size)[0]
+
+    def pre_validate(self, form):
+        if self.data and self.provider is not None and not self.provider.contains(self.entity_type, self.data):
+            raise ValueError('Not a valid choice')
+
+
+class DynamicForm(Form):
+    """Base class of the generated device forms.
+
+    Generated classes are cached per device type, so per-request data is bound when the form is
+    instantiated: the choice provider of the relationship fields and default values via ``data``.
+    """
+    choice_queries = {}
+
+    def __init__(self, formdata=None, provider=None, **kwargs):
+        super(DynamicForm, self).__init__(formdata, **kwargs)
+        for name in self.choice_queries:
+            self[name].provider = provider
+
+
 class FormService(object):
 
-    def create_form_field(self, properties_dict, orion, is_edit=False):
-        properties = list(properties_dict.values())
+    def __init__(self, choices=None):
+        self.choices = choices
+        self._form_classes = {}
+        self._lock = threading.Lock()
+
+    def create_form_field(self, properties):
+        """Create unbound fields for the property records and the entity type of each relationship field"""
+        properties = list(properties)
         properties.sort()  # Sort it depends on the number in data model
 
         form_fields = {}
+        choice_queries = {}
 
         for form_field in properties:
             (order, name, property, optional, data_type, value) = form_field
@@ -24,74 +97,85 @@ class FormService(object):
                 validators_field = [validators.DataRequired()]
 
             if data_type == 'datetime':
-                if value:
-                    form_fields[property] = DateTimeField(name, default=value,
-                                                          validators=validators_field)
-                else:
-                    form_fields[property] = DateTimeField(name, default=datetime.now(),
-                                                          validators=validators_field)
+                form_fields[property] = DateTimeField(name, default=datetime.now, validators=validators_field)
             elif data_type == 'string':
-                if value:
-                    form_fields[property] = StringField(name, validators=validators_field, default=value)
-                else:
-                    form_fields[property] = StringField(name, validators=validators_field)
+                form_fields[property] = StringField(name, validators=validators_field)
             elif data_type == 'select':
-                items = orion.get_entities(name)
-                values = [('', '',)]
-                for item in items:
-                    values.append((item['id'], item['id'],))
-                if value:
-                    form_fields[property] = SelectField(name, choices=values, validators=validators_field,
-                                                            default=value)
-                else:
-                    form_fields[property] = SelectField(name, choices=values, validators=validators_field)
+                form_fields[property] = SearchField(name, validators=validators_field, entity_type=name)
+                choice_queries[property] = name
             else:
-                items = orion.get_entities(data_type)
-                values = [('', '',)]
-                for item in items:
-                    values.append((item['id'], item['id'],))
-                if value:
-                    value = str(value).replace('[', '').replace(']', '').replace('\'', '')
-                    form_fields[property] = SelectField(name, validators=validators_field, default=value,
-                                                        choices=values)
-                else:
-                    form_fields[property] = SelectField(name, validators=validators_field, choices=values)
-        return form_fields
-
+                form_fields[property] = SearchField(name, validators=validators_field, entity_type=data_type)
+                choice_queries[property] = data_type
+        return form_fields, choice_queries
+
+    def get_form_class(self, key, source, build):
+        """Return cached form class for the key, build() it again when the source schema has changed"""
+        entry = self._form_classes.get(key)
+        if entry is not None and entry[0] is source:
+            metrics.record_cache('form_classes', True)
+            return entry[1]
+        metrics.record_cache('form_classes', False)
+        with self._lock:
+            entry = self._form_classes.get(key)
+            if entry is not None and entry[0] is source:
+                return entry[1]
+            form_fields, choice_queries = build()
+            attributes = dict(form_fields, choice_queries=choice_queries)
+            form_class = type('DynamicForm', (DynamicForm,), attributes)
+            self._form_classes[key] = (source, form_class)
+        return form_class
+
+    def get_provider(self, orion):
+        if self.choices is None:
+            self.choices = ChoiceProvider(orion)
+        return self.choices
+
+    def bind_form(self, form_class, orion, defaults=None):
+        """Bind choice provider and defaults, the result is called like the form class.
+
+        Ids of all types referenced by the form are loaded in one query before the fields render.
+        """
+        provider = self.get_provider(orion)
+        provider.get_indexes(form_class.choice_queries.values())
+        return partial(form_class, provider=provider, data=defaults)
+
+    @timing.timed('forms')
     def create_form_entity(self, device_id, device_type, orion, datamodel):
         """Create WTForm object from entity"""
 
         properties_dict = datamodel.get_properties_dict(device_type)
 
         device = orion.get_entity_by_id(device_id)
-        form_fields = {}
-
-        class DynamicForm(Form):
-            """Dynamic form object for managing WTForm"""
-            pass
-
-        form_fields['device_id'] = StringField('id', default=device_id, render_kw={'readonly': True})
-        form_fields['device_type'] = StringField('Type', default=self.get_device_type(device_type), render_kw={'readonly': True})
-        form_fields['context'] = HiddenField('context', default=device['@context'])
 
         properties = {}
+        defaults = {'device_id': device_id, 'context': device['@context']}
         for key, value in device.items():
-            if 'type' in value and value['type'] == 'Property':
-                if key in properties_dict:
-                    (order, name, property, optional, data_type, val) = properties_dict[key]
-                    properties[key] = (order, name, key, optional, data_type, value['value'],)
-
-            if 'type' in value and value['type'] == 'Relationship':
-                if key in properties_dict:
-                    (order, name, property, optional, data_type, val) = properties_dict[key]
-                    properties[key] = (order, name, key, optional, data_type, self.relationship_value(value['object']),)
-
-        form_fields.update(self.create_form_field(properties, orion))
-
-        for key, value in form_fields.items():
-            setattr(DynamicForm, key, value)
-
-        return DynamicForm
+            if key not in properties_dict or 'type' not in value:
+                continue
+            if value['type'] == 'Property':
+                data = value['value']
+            elif value['type'] == 'Relationship':
+                data = self.relationship_value(value['object'])
+            else:
+                continue
+            properties[key] = properties_dict[key]._replace(property=key)
+            if data and properties[key].data_type not in ('datetime', 'string', 'select'):
+                data = str(data).replace('[', '').replace(']', '').replace('\'', '')
+            if data:
+                defaults[key] = data
+
+        def build():
+            form_fields = {}
+            form_fields['device_id'] = StringField('id', render_kw={'readonly': True})
+            form_fields['device_type'] = StringField('Type', default=self.get_device_type(device_type),
+                                                     render_kw={'readonly': True})
+            form_fields['context'] = HiddenField('context')
+            fields, choice_queries = self.create_form_field(properties.values())
+            form_fields.update(fields)
+            return form_fields, choice_queries
+
+        form_class = self.get_form_class(('entity', device_type, frozenset(properties)), properties_dict, build)
+        return self.bind_form(form_class, orion, defaults)
 
     def create_entity_update(self, params):
         values = {}
@@ -109,42 +193,39 @@ class FormService(object):
             return str(value).replace('[', '').replace(']', '').replace('\'', '')
         return value
 
+    @timing.timed('forms')
     def create_form_json(self, device_type, orion, datamodel):
         """Generate forms based on the provided data template"""
-        device = datamodel.create_iotdevice_from_json(device_type)
+        device = datamodel.get_iotdevice_definition(device_type)
 
-        form_fields = {}
+        def build():
+            form_fields = {}
+            choice_queries = {}
 
-        class DynamicForm(Form):
-            """Dynamic form object for managing WTForm"""
-            pass
+            for key, value in device.items():
+                if isinstance(value, Mapping):
+                    validators_field = []
+                    if value['required'] == 'true':
+                        validators_field = [validators.DataRequired()]
+                    form_fields[value['name']] = StringField(value['label'], validators=validators_field)
 
-        for key, value in device.items():
-            if type(value) == dict:
+            for attr in device['static_attributes']:
                 validators_field = []
-                if value['required'] == 'true':
+                if attr['required'] == 'true':
                     validators_field = [validators.DataRequired()]
-                form_fields[value['name']] = StringField(value['label'], validators=validators_field)
-
-        for attr in device['static_attributes']:
-            validators_field = []
-            if attr['required'] == 'true':
-                validators_field = [validators.DataRequired()]
 
-            if attr['type'] == 'Property' or 'query' not in attr or attr['query'] == '':
-                form_fields[attr['name']] = StringField(attr['label'], validators=validators_field)
-            else:
-                items = orion.get_entities(attr['query'])
-                values = [('', '',)]
-                for item in items:
-                    values.append((item['id'], item['id'],))
-                form_fields[attr['name']] = SelectField(attr['label'], choices=values, validators=validators_field)
-
-        for key, value in form_fields.items():
-            setattr(DynamicForm, key, value)
+                if attr['type'] == 'Property' or 'query' not in attr or attr['query'] == '':
+                    form_fields[attr['name']] = StringField(attr['label'], validators=validators_field)
+                else:
+                    form_fields[attr['name']] = SearchField(attr['label'], validators=validators_field,
+                                                            entity_type=attr['query'])
+                    choice_queries[attr['name']] = attr['query']
+            return form_fields, choice_queries
 
-        return DynamicForm
+        form_class = self.get_form_class(('json', device_type), device, build)
+        return self.bind_form(form_class, orion)
 
+    @timing.timed('forms')
     def create_iotdevice(self, device_type, params, datamodel):
         device = datamodel.create_iotdevice_from_json(device_type)
 
@@ -170,20 +251,16 @@ class FormService(object):
         device['static_attributes'] = static_attributes
         return device
 
+    @timing.timed('forms')
     def create_form_template(self, device_type, orion, datamodel):
         """Create WTForm object from template"""
         properties_dict = datamodel.get_properties_dict(device_type)
 
-        form_fields = self.create_form_field(properties_dict, orion)
-
-        class DynamicForm(Form):
-            """Dynamic form object for managing WTForm"""
-            pass
-
-        for key, value in form_fields.items():
-            setattr(DynamicForm, key, value)
+        def build():
+            return self.create_form_field(properties_dict.values())
 
-        return DynamicForm, properties_dict
+        form_class = self.get_form_class(('template', device_type), properties_dict, build)
+        return self.bind_form(form_class, orion), properties_dict
 
     def get_device_type(self, device_type):
         """Convert file name to Device Type"""
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+
+import os
+
+
+class HealthMonitor(object):
+    """Probe upstream services in background and cache their status.
+
+    Every registered service is probed each ``interval`` seconds by a daemon thread. Cached results
+    are valid for ``ttl`` seconds; a stale or missing status is probed synchronously, so the monitor
+    still works when the background thread could not be started (e.g. uwsgi without threads).
+    """
+    interval = 15
+    ttl = 60
+    timeout = 5
+
+    def __init__(self, config={}):
+        self.interval = config.get('interval', self.interval)
+        self.ttl = config.get('ttl', self.ttl)
+        self.timeout = config.get('timeout', self.timeout)
+        self._probes = {}
+        self._status = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def register(self, name, probe, url=''):
+        """Register probe for the service. Probe returns version string or boolean"""
+        self._probes[name] = (probe, url)
+
+    def check(self, name):
+        """Probe service and update the cached status"""
+        probe, url = self._probes[name]
+        version, error = '', None
+        start = time.time()
+        try:
+            version = probe()
+        except Exception as e:
+            error = str(e)
+        latency = time.time() - start
+
+        status = {
+            'name': name,
+            'url': url,
+            'active': bool(version),
+            'version': version if isinstance(version, str) else '',
+            'latency': round(latency * 1000, 2),
+            'checked_at': time.time(),
+            'error': error
+        }
+        with self._lock:
+            self._status[name] = status
+        return status
+
+    def check_all(self):
+        for name in list(self._probes):
+            self.check(name)
+
+    def status(self, name):
+        """Return cached status of the service, probe it if the status is stale"""
+        with self._lock:
+            status = self._status.get(name)
+        if status is None or time.time() - status['checked_at'] > self.ttl:
+            status = self.check(name)
+        return status
+
+    def is_active(self, name):
+        return self.status(name)['active']
+
+    def version(self, name):
+        return self.status(name)['version']
+
+    def to_dict(self, details=True):
+        """Return overall and per-service status, without URLs, versions and errors unless details is set"""
+        services = {}
+        for name in self._probes:
+            status = dict(self.status(name))
+            status['age'] = round(time.time() - status['checked_at'], 2)
+            services[name] = status if details else {'active': status['active']}
+        return {
+            'status': 'ok' if all(s['active'] for s in services.values()) else 'degraded',
+            'services': services
+        }
+
+    def start(self):
+        """Start background probing in the current process if it is not running yet"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check_all()
+            except Exception as e:
+                logging.error('Health monitor: {}'.format(e))
+            self._stop.wait(self.interval)
@@ -1,33 +1,97 @@
 import logging
+import threading
+import time
 
 import xxhash
-from keycloak import KeycloakAdmin
+from keycloak import KeycloakAdmin, KeycloakOpenID
+from keycloak.exceptions import KeycloakAuthenticationError, KeycloakError
 
+import metrics
 
+
+@metrics.instrument
 class IDM(object):
+    """Device IDM backed by a long-lived Keycloak admin client.
+
+    The admin client and its access token are cached for the lifetime of the process. The token is
+    refreshed ``refresh_margin`` seconds before it expires and a call rejected with 401 triggers one
+    re-login before it is retried.
+    """
     config = {}
+    refresh_margin = 30
 
     def __init__(self, config):
         try:
             self.config = config
         except Exception as e:
             logging.error('Init IDM service for Device Registration', e)
+        self._keycloak = None
+        self._openid = None
+        self._expires_at = 0
+        self._lock = threading.RLock()
+
+    def _login(self):
+        """Perform password grant and replace the cached admin client"""
+        keycloak = KeycloakAdmin(server_url=self.config['server'],
+                                 username=self.config['username'],
+                                 password=self.config['password'],
+                                 realm_name=self.config['realm_name'],
+                                 verify=True)
+        self._expires_at = time.time() + keycloak.token.get('expires_in', 60)
+        self._keycloak = keycloak
+        return keycloak
+
+    def _refresh(self):
+        """Refresh access token of the cached admin client, fall back to a new login"""
+        refresh_token = self._keycloak.token.get('refresh_token')
+        if refresh_token is None:
+            return self._login()
+        try:
+            if self._openid is None:
+                self._openid = KeycloakOpenID(server_url=self.config['server'],
+                                              client_id=self._keycloak.client_id,
+                                              realm_name=self.config['realm_name'],
+                                              verify=True)
+            token = self._openid.refresh_token(refresh_token)
+        except KeycloakError as e:
+            logging.info('Refresh Keycloak token failed, login again: {}'.format(e))
+            return self._login()
+        self._keycloak.token = token
+        self._keycloak.connection.add_param_headers('Authorization', 'Bearer ' + token.get('access_token'))
+        self._expires_at = time.time() + token.get('expires_in', 60)
+        return self._keycloak
 
     def _get_keycloack(self):
-        return KeycloakAdmin(server_url=self.config['server'],
-                             username=self.config['username'],
-                             password=self.config['password'],
-                             realm_name=self.config['realm_name'],
-                             verify=True)
+        with self._lock:
+            if self._keycloak is None:
+                return self._login()
+            if time.time() >= self._expires_at - self.refresh_margin:
+                return self._refresh()
+            return self._keycloak
+
+    def _call(self, func):
+        """Run func with the cached admin client and retry once after a 401"""
+        keycloak = self._get_keycloack()
+        try:
+            return func(keycloak)
+        except KeycloakError as e:
+            if not isinstance(e, KeycloakAuthenticationError) and e.response_code != 401:
+                raise
+            with self._lock:
+                if self._keycloak is keycloak:
+                    keycloak = self._login()
+                else:
+                    keycloak = self._keycloak
+            return func(keycloak)
 
     def create_entity(self, device_id, device_type):
         mqtt_write_topics = self.create_topic(device_id, device_type)
-        return self._get_keycloack().create_user({"username": device_id,
-                                                  "credentials": [{"value": "secret", "type": "password", }],
-                                                  "enabled": True,
-                                                  "firstName": device_type,
-                                                  "lastName": device_type,
-                                                  "attributes": {"mqtt_write_topics": mqtt_write_topics}})
+        return self._call(lambda keycloak: keycloak.create_user({"username": device_id,
+                                                                 "credentials": [{"value": "secret", "type": "password", }],
+                                                                 "enabled": True,
+                                                                 "firstName": device_type,
+                                                                 "lastName": device_type,
+                                                                 "attributes": {"mqtt_write_topics": mqtt_write_topics}}))
 
     @staticmethod
     def create_topic(device_id, device_type):
@@ -37,18 +101,26 @@ class IDM(object):
     @staticmethod
     def create_apikey(device_type):
         device_type = device_type.split(".")[0]
-        api_key = xxhash.xxh64(device_type).hexdigest()
+        api_key = xxhash.xxh64(device_type.encode('utf-8')).hexdigest()
         return 'n5geh{api_key}'.format(api_key=api_key)
 
+    def entity_exists(self, device_id):
+        """Check if the user of the device exists"""
+        return self._call(lambda keycloak: keycloak.get_user_id(device_id.lower()) is not None)
+
     def delete_entity(self, device_id):
-        keycloack = self._get_keycloack()
-        user_id = keycloack.get_user_id(device_id.lower())
-        if user_id is not None:
-            keycloack.delete_user(user_id=user_id)
+        """Delete user of the device, return False if there was none"""
+        def delete(keycloack):
+            user_id = keycloack.get_user_id(device_id.lower())
+            if user_id is not None:
+                keycloack.delete_user(user_id=user_id)
+                return True
+            return False
+        return self._call(delete)
 
     def is_active(self):
         try:
-            self._get_keycloack()
+            self._call(lambda keycloak: keycloak.users_count())
             return True
         except Exception as e:
             pass
@@ -0,0 +1,192 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import os
+
+
+class Job(object):
+    """Handle passed to a running job function to report its progress"""
+    progress_interval = 0.5
+
+    def __init__(self, runner, job_id, params):
+        self.runner = runner
+        self.id = job_id
+        self.params = params
+        self._reported = 0
+
+    def progress(self, done, total=None, message=None):
+        """Store progress of the job, at most every ``progress_interval`` seconds unless it is complete"""
+        now = time.time()
+        if total is not None and done < total and now - self._reported < self.progress_interval:
+            return
+        self._reported = now
+        fields = {'done': done, 'heartbeat': now}
+        if total is not None:
+            fields['total'] = total
+        if message is not None:
+            fields['message'] = message
+        self.runner.update(self.id, **fields)
+
+
+class JobRunner(object):
+    """Run long admin operations in background threads of the worker process.
+
+    Jobs are stored in a SQLite database shared by all uwsgi workers, so their status can be polled
+    from any worker and survives a restart. A job is run by a function registered for its kind,
+    ``func(job, **params)``, whose JSON serializable return value is stored as the result. Jobs
+    which were queued or running in a worker that went away (no heartbeat for ``stale`` seconds)
+    are picked up again by the next started runner, up to ``max_attempts`` times, so job functions
+    have to be idempotent.
+    """
+    path = 'jobs.sqlite'
+    max_workers = 2
+    stale = 300
+    max_attempts = 3
+    keep = 7 * 24 * 3600
+
+    def __init__(self, config={}):
+        self.path = config.get('path', self.path)
+        self.max_workers = config.get('max_workers', self.max_workers)
+        self.stale = config.get('stale', self.stale)
+        self.max_attempts = config.get('max_attempts', self.max_attempts)
+        self.keep = config.get('keep', self.keep)
+        self._kinds = {}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0, total INTEGER, message TEXT, result TEXT, error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0, owner INTEGER, created_at REAL NOT NULL,
+                heartbeat REAL NOT NULL, finished_at REAL)''')
+
+    @contextmanager
+    def _connect(self):
+        """Open connection to the job database, commit and close it when the block ends"""
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def register(self, kind, func):
+        self._kinds[kind] = func
+
+    @property
+    def executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='jobs')
+                    self._pid = os.getpid()
+                    self._executor.submit(self.recover)
+        return self._executor
+
+    def start(self):
+        """Create the worker pool of the current process and resume interrupted jobs"""
+        return self.executor
+
+    def submit(self, kind, **params):
+        """Store new job of the kind and queue it, return its id"""
+        if kind not in self._kinds:
+            raise ValueError('Unknown job kind {}'.format(kind))
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT INTO jobs (id, kind, params, status, created_at, heartbeat) VALUES (?, ?, ?, ?, ?, ?)',
+                       (job_id, kind, json.dumps(params), 'queued', now, now))
+        self.executor.submit(self._run, job_id)
+        return job_id
+
+    def update(self, job_id, **fields):
+        columns = ', '.join('{} = ?'.format(name) for name in fields)
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET {} WHERE id = ?'.format(columns), list(fields.values()) + [job_id])
+
+    def _claim(self, job_id):
+        """Mark job as running in this process unless another worker runs it"""
+        now = time.time()
+        with self._connect() as db:
+            cursor = db.execute('''UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, attempts = attempts + 1
+                WHERE id = ? AND (status = 'queued' OR (status = 'running' AND heartbeat < ?))''',
+                                (os.getpid(), now, job_id, now - self.stale))
+            if cursor.rowcount != 1:
+                return None
+            return db.execute('SELECT kind, params FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def _heartbeat(self, job_id, stopped):
+        """Keep heartbeat of the running job fresh, so it is not taken over by other workers"""
+        while not stopped.wait(self.stale / 3.0):
+            try:
+                self.update(job_id, heartbeat=time.time())
+            except sqlite3.Error as e:
+                logging.error('Heartbeat of job {}: {}'.format(job_id, e))
+
+    def _run(self, job_id):
+        row = self._claim(job_id)
+        if row is None:
+            return
+        params = json.loads(row['params'])
+        stopped = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, stopped), name='jobs-heartbeat', daemon=True).start()
+        try:
+            result = self._kinds[row['kind']](Job(self, job_id, params), **params)
+        except Exception as e:
+            logging.error('Job {} {} failed: {}'.format(row['kind'], job_id, e))
+            self.update(job_id, status='failed', error=str(e), finished_at=time.time(), heartbeat=time.time())
+        else:
+            self.update(job_id, status='succeeded', result=json.dumps(result), finished_at=time.time(),
+                        heartbeat=time.time())
+        finally:
+            stopped.set()
+
+    def recover(self):
+        """Queue again jobs interrupted by a stopped worker and remove old finished jobs"""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - self.keep,))
+            rows = db.execute("SELECT id, attempts FROM jobs WHERE status IN ('queued', 'running') AND heartbeat < ?",
+                              (now - self.stale,)).fetchall()
+            for row in rows:
+                if row['attempts'] >= self.max_attempts:
+                    db.execute('''UPDATE jobs SET status = 'failed', error = ?, finished_at = ?
+                        WHERE id = ? AND status IN ('queued', 'running') AND heartbeat < ?''',
+                               ('Interrupted {} times'.format(row['attempts']), now, row['id'], now - self.stale))
+        for row in rows:
+            if row['attempts'] < self.max_attempts:
+                logging.info('Resuming job {}'.format(row['id']))
+                self._run(row['id'])
+
+    def get(self, job_id):
+        """Return job as dict or None"""
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def list(self, limit=20):
+        """Return latest jobs without params and results"""
+        with self._connect() as db:
+            rows = db.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        jobs = []
+        for row in rows:
+            job = self._to_dict(row)
+            job.pop('params')
+            job.pop('result')
+            jobs.append(job)
+        return jobs
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
@@ -1,15 +1,26 @@
+import csv
+import io
 import json
 import logging
 
 import os
-from flask import Flask, render_template, redirect, request, g
-from flask_oidc import OpenIDConnect
-from functools import wraps
+from flask import Flask, Response, render_template, redirect, request, g, jsonify
+from functools import wraps, partial
 
+from auth import CachedOpenIDConnect
+from bulk import BulkImporter, BulkDeleter
+from choices import ChoiceProvider
 from datamodel import Datamodel
+from datatables import DataTablesQuery
+from fanout import FanOut
 from fiware import Orion, IoTAgent, QuantumLeap
 from forms import TypesForm, FormService
+from health import HealthMonitor
 from idm import IDM
+from jobs import JobRunner
+import metrics
+from streaming import stream_json
+import timing
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -32,10 +43,17 @@ def create_app(entirety_config, client_secret):
         'FIWARE': entirety_config['fiware'],
         'DEVICE_IDM': entirety_config['device_idm'],
         'DATAMODEL': entirety_config['datamodel'],
-        'IDM': entirety_config['idm']
+        'IDM': entirety_config['idm'],
+        'HEALTH': entirety_config.get('health', {}),
+        'FANOUT': entirety_config.get('fanout', {}),
+        'CHOICES': entirety_config.get('choices', {}),
+        'BULK': entirety_config.get('bulk', {}),
+        'JOBS': entirety_config.get('jobs', {}),
+        'AUTH': entirety_config.get('auth', {}),
+        'TIMING': entirety_config.get('timing', {})
     })
 
-    oidc = OpenIDConnect(app)  # OpenIDConnect provides security mechanism for API
+    oidc = CachedOpenIDConnect(app, config=app.config['AUTH'])  # OpenIDConnect provides security mechanism for API
 
     datamodel = Datamodel(config=app.config['DATAMODEL'])
 
@@ -47,7 +65,33 @@ def create_app(entirety_config, client_secret):
 
     idm = IDM(config=app.config['DEVICE_IDM'])
 
-    formservice = FormService()
+    formservice = FormService(ChoiceProvider(orion, config=app.config['CHOICES']))
+
+    max_delete = app.config['BULK'].get('max_delete', 1000)
+
+    bulk = BulkImporter(iotagent, idm, datamodel, formservice, orion, config=app.config['BULK'])
+
+    fanout = FanOut(config=app.config['FANOUT'])
+
+    # bulk deletes get their own pool, so they do not starve the dashboard calls
+    delete_fanout = FanOut(config={'max_workers': app.config['BULK'].get('max_workers', FanOut.max_workers),
+                                   'deadline': app.config['BULK'].get('deadline', FanOut.deadline)})
+
+    deleter = BulkDeleter(orion, iotagent, idm, delete_fanout)
+
+    health = HealthMonitor(config=app.config['HEALTH'])
+
+    jobs = JobRunner(config=app.config['JOBS'])
+    health.register('orion', lambda: orion.get_version(timeout=health.timeout), orion.url)
+    health.register('iotagent', lambda: iotagent.get_version(timeout=health.timeout), iotagent.url)
+    health.register('keycloak', idm.is_active, idm.config.get('server', ''))
+    health.register('quantumleap', lambda: quantumleap.get_version(timeout=health.timeout), quantumleap.url)
+
+    metrics.init_app(app)
+
+    timing.init_app(app, enabled=app.config['TIMING'].get('server_timing', True))
+
+    profiler = timing.Profiler(config=app.config['TIMING'])
 
     # General routes
     @app.errorhandler(404)
@@ -55,6 +99,16 @@ def create_app(entirety_config, client_secret):
         """Render not found page"""
         return render_template("404.html")
 
+    @app.before_request
+    def start_health_monitor():
+        """Start upstream probing in the worker process"""
+        health.start()
+
+    @app.before_request
+    def start_jobs():
+        """Start job workers in the worker process and resume interrupted jobs"""
+        jobs.start()
+
     @app.before_request
     def before_request():
         """Add user details to each request"""
@@ -67,6 +121,16 @@ def create_app(entirety_config, client_secret):
             g.user = None
             g.fullname = None
 
+    @app.before_request
+    def start_profiler():
+        """Profile the request if an admin asks for it"""
+        if profiler.requested(g.user):
+            profiler.start()
+
+    @app.after_request
+    def stop_profiler(response):
+        return profiler.stop(response)
+
     @app.route('/')
     def index():
         """Default web page"""
@@ -76,22 +140,50 @@ def create_app(entirety_config, client_secret):
     @oidc.require_login
     def dashboard():
         """Dashboard web page"""
-        data = {}
-        data['orion_version'] = orion.get_version()
-        data['iot_agent_version'] = iotagent.get_version()
-        data['idm_is_active'] = idm.is_active()
-        data['quantumleap_version'] = quantumleap.get_version()
-        data['classes'] = datamodel.get_classes()
-        data['subscription_number'] = len(orion.get_subscriptions())
-
-        count = 0
-        if data['orion_version'] != '':
-            for c in data['classes']:
-                count += len(orion.get_entities(c))
-        data['registered_classes'] = count
+        classes = datamodel.get_classes()
+        calls = {
+            'orion_version': lambda: health.version('orion'),
+            'iot_agent_version': lambda: health.version('iotagent'),
+            'idm_is_active': lambda: health.is_active('keycloak'),
+            'quantumleap_version': lambda: health.version('quantumleap'),
+            'subscription_number': orion.count_subscriptions
+        }
+        if health.is_active('orion'):
+            calls['registered_classes'] = partial(orion.count_entities_by_types, classes)
+        results, missing = fanout.run(calls)
+
+        data = {
+            'orion_version': results.get('orion_version', ''),
+            'iot_agent_version': results.get('iot_agent_version', ''),
+            'idm_is_active': results.get('idm_is_active', False),
+            'quantumleap_version': results.get('quantumleap_version', ''),
+            'subscription_number': results.get('subscription_number'),
+            'classes': classes,
+            'missing': missing
+        }
+        data['registered_classes'] = results.get('registered_classes', 0)
+        data['registered_classes_complete'] = 'registered_classes' not in missing
         data['all_classes'] = len(datamodel.classes_file_list)
         return render_template('dashboard.html', d=data)
 
+    @app.route('/health')
+    def get_health():
+        """Return cached status of the upstream services for liveness checks"""
+        return jsonify(health.to_dict(details=False))
+
+    @app.route('/health/details')
+    @oidc.require_login
+    def get_health_details():
+        """Return cached status, URL, version, error and latency of the upstream services and cache stats"""
+        data = health.to_dict()
+        data['caches'] = oidc.cache_stats()
+        return jsonify(data)
+
+    @app.route('/metrics')
+    def get_metrics():
+        """Return metrics of all workers in the Prometheus text format"""
+        return Response(metrics.generate(), content_type=metrics.CONTENT_TYPE)
+
     @app.route('/about')
     @oidc.require_login
     def about():
@@ -136,7 +228,7 @@ def create_app(entirety_config, client_secret):
         """Check if Orion is available"""
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            if orion.get_version() == '':
+            if not health.is_active('orion'):
                 page_name, page_content = ('Orion LD', 'Could not connect to the Orion LD. URL: {}'.format(orion.url),)
                 return render_template('simple.html', page_name=page_name, page_content=page_content)
             return func(*args, **kwargs)
@@ -146,7 +238,7 @@ def create_app(entirety_config, client_secret):
         """Check if Keycloak is available"""
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            if not idm.is_active():
+            if not health.is_active('keycloak'):
                 page_name, page_content = ('Keycloack', 'Could not connect to the Keycloack IDM. URL: {}'.format(idm.config['server']),)
                 return render_template('simple.html', page_name=page_name, page_content=page_content)
             return func(*args, **kwargs)
@@ -156,7 +248,7 @@ def create_app(entirety_config, client_secret):
         """Check if IoT Agent is available"""
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            if iotagent.get_version() == '':
+            if not health.is_active('iotagent'):
                 page_name, page_content = ('IoT Agent', 'Could not connect to the IoT Agent. URL: {}'.format(iotagent.url),)
                 return render_template('simple.html', page_name=page_name, page_content=page_content)
             return func(*args, **kwargs)
@@ -166,7 +258,7 @@ def create_app(entirety_config, client_secret):
         """Check if QuantumLeap is available"""
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            if quantumleap.get_version() == '':
+            if not health.is_active('quantumleap'):
                 page_name, page_content = ('QuantumLeap', 'Could not connect to the QuantumLeap. URL: {}'.format(quantumleap.url),)
                 return render_template('simple.html', page_name=page_name, page_content=page_content)
             return func(*args, **kwargs)
@@ -256,11 +348,31 @@ def create_app(entirety_config, client_secret):
             return wrong_device_type(device_type, '/orion/device', 'Orion LD')
 
         device_type = device_type.split(".")[0]
-        devices = orion.get_entities(device_type)
-        for device in devices:
-            device['mqtt_topic'] = idm.create_topic(device['id'], device_type)
-            device['mqtt_user'] = device['id'].lower()
-        return render_template('orion/devices_to_json.html', devices=devices, device_type=device_type)
+        query = DataTablesQuery(request.args)
+
+        def get_page(offset, limit):
+            return orion.get_entities_page(device_type, offset, limit, id_pattern=query.id_pattern)
+
+        devices, filtered = query.fetch(get_page)
+        total = orion.count_entities(device_type) if query.search else filtered
+        data = ({'device_id': device['id'],
+                 'mqtt_user': device['id'].lower(),
+                 'mqtt_topic': idm.create_topic(device['id'], device_type),
+                 'context': device.get('@context')} for device in devices)
+        return stream_json(data, envelope=query.response(None, total, filtered))
+
+    @app.route('/orion/search', methods=['GET'])
+    @oidc.require_login
+    def orion_search():
+        """Search ids of entities of the type starting with the query, one page at a time"""
+        entity_type = request.args.get('type')
+        if not entity_type:
+            return jsonify({'error': 'Parameter type is required'}), 400
+        query = request.args.get('q', '').strip()
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        results, total = formservice.get_provider(orion).search(entity_type, query, offset, limit)
+        return jsonify({'results': results, 'total': total, 'more': offset + len(results) < total})
 
     @app.route('/orion/subscriptions', methods=['GET', 'POST'])
     @oidc.require_login
@@ -273,8 +385,12 @@ def create_app(entirety_config, client_secret):
     @oidc.require_login
     def get_orion_subscriptions_json():
         """Render Orion subscriptions as JSON"""
-        subscriptions = orion.get_subscriptions()
-        return render_template('orion/subscriptions_to_json.html', subscriptions=subscriptions)
+        data = ([subscription['id'],
+                 subscription.get('description', ''),
+                 subscription.get('status', ''),
+                 subscription['subject']['entities'][0].get('idPattern', '')]
+                for subscription in orion.iter_subscriptions())
+        return stream_json(data, envelope={})
 
     @app.route('/orion/delete', methods=['GET'])
     @oidc.require_login
@@ -287,21 +403,98 @@ def create_app(entirety_config, client_secret):
         idm.delete_entity(device_id)
         return "true"
 
+    def requested_ids():
+        """Return unique device ids posted as JSON {"ids": [...]} or form fields ids"""
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids') if isinstance(data, dict) else None
+        if ids is None:
+            ids = request.form.getlist('ids')
+        return list(dict.fromkeys(str(i) for i in ids if i))
+
+    def delete_job_response(job_name, ids):
+        """Queue the bulk delete job, reject requests with more than max_delete ids"""
+        if len(ids) > max_delete:
+            return jsonify({'error': 'At most {} devices can be removed at once, {} were selected'.format(
+                max_delete, len(ids))}), 400
+        return job_response(jobs.submit(job_name, ids=ids))
+
+    def job_result(report):
+        """Result of a job with per-item report and counts by status"""
+        summary = {}
+        for r in report:
+            summary[r['status']] = summary.get(r['status'], 0) + 1
+        return {'summary': summary, 'items': report}
+
+    def job_response(job_id):
+        """Return id and status URL of the queued job, or redirect browsers to the job page"""
+        if request.accept_mimetypes.best == 'application/json' or request.is_json:
+            return jsonify({'id': job_id, 'url': '/jobs/{}'.format(job_id)}), 202
+        return redirect('/jobs/{}/view'.format(job_id))
+
+    def delete_orion_devices(job, ids):
+        """Job removing devices from Orion in batches and their users"""
+        return job_result(deleter.delete_orion(ids, progress=job.progress))
+
+    def delete_iotagent_devices(job, ids):
+        """Job removing devices from IoT Agent and their users concurrently"""
+        return job_result(deleter.delete_iotagent(ids, progress=job.progress))
+
+    def register_classes(job):
+        """Job creating entities of the datamodel classes which do not exist yet"""
+        entities = datamodel.get_class_entities()
+        report = []
+        job.progress(0, len(entities))
+        for start in range(0, len(entities), orion.batch_size):
+            report.extend(orion.batch_create(entities[start:start + orion.batch_size]))
+            job.progress(len(report), len(entities))
+        return job_result(report)
+
+    def init_subscriptions(job):
+        """Job creating QuantumLeap subscriptions of the device types which have none yet"""
+        device_types = datamodel.iotdevice_types
+        patterns = set()
+        for subscription in orion.iter_subscriptions():
+            for entity in subscription.get('subject', {}).get('entities', []):
+                patterns.add(entity.get('idPattern'))
+        report = []
+        for device_type in device_types:
+            if orion.get_subscription_pattern(device_type) in patterns:
+                report.append({'id': device_type, 'status': 'exists', 'error': None})
+            else:
+                result = orion.create_subscription(device_type)
+                if result['status']:
+                    report.append({'id': device_type, 'status': 'created', 'error': None})
+                else:
+                    report.append({'id': device_type, 'status': 'failed', 'error': str(result['error'])})
+            job.progress(len(report), len(device_types), device_type)
+        return job_result(report)
+
+    def bulk_import(job, device_type, rows):
+        """Job provisioning IoT Agent devices from the uploaded rows"""
+        report = bulk.run(device_type, rows, progress=job.progress)
+        return job_result(report['rows'])
+
+    jobs.register('delete_orion_devices', delete_orion_devices)
+    jobs.register('delete_iotagent_devices', delete_iotagent_devices)
+    jobs.register('register_classes', register_classes)
+    jobs.register('init_subscriptions', init_subscriptions)
+    jobs.register('bulk_import', bulk_import)
+
+    @app.route('/orion/delete_many', methods=['POST'])
+    @oidc.require_login
+    @check_orion
+    @check_keycloak
+    def orion_delete_many():
+        """Queue job deleting devices from Orion and their users"""
+        return delete_job_response('delete_orion_devices', requested_ids())
+
     @app.route('/orion/init_subscriptions', methods=['GET'])
     @oidc.require_login
     @check_orion
     @check_quantumleap
     def orion_init_subscription():
-        """Init QuantumLeap subscriptions in Orion for the Datamodel"""
-        devices_types = datamodel.iotdevice_types
-        for devices_type in devices_types:
-            try:
-                result = orion.create_subscription(devices_type)
-            except Exception as e:
-                pass
-        page_name = 'Success'
-        page_content = 'Subscriptions successfully registered. Go to <a href="/iotagent/device">+ IoT Agent device</a>.'
-        return render_template('simple.html', page_name=page_name, page_content=page_content)
+        """Queue job creating QuantumLeap subscriptions in Orion for the Datamodel"""
+        return job_response(jobs.submit('init_subscriptions'))
 
     @app.route('/orion/delete_subscription', methods=['GET'])
     @oidc.require_login
@@ -316,18 +509,8 @@ def create_app(entirety_config, client_secret):
     @oidc.require_login
     @check_orion
     def orion_register_classes():
-        """Register properties classes for the Datamodel"""
-        classes = datamodel.get_classes_files()
-        for cls in classes:
-            if os.path.isfile(cls):
-                data = open(cls, 'rt').read()
-                try:
-                    result = orion.create_entity(data)
-                except Exception as e:
-                    pass
-        page_name = 'Success'
-        page_content = 'Classes successfully registered. Go to <a href="/iotagent/device">+ IoT Agent device</a>.'
-        return render_template('simple.html', page_name=page_name, page_content=page_content)
+        """Queue job registering properties classes for the Datamodel"""
+        return job_response(jobs.submit('register_classes'))
 
     # IoT Agent routes
     @app.route('/iotagent/device', methods=['GET', 'POST'])
@@ -356,14 +539,7 @@ def create_app(entirety_config, client_secret):
                     else:
                         params[fieldname] = value
 
-                services = iotagent.get_services()
-                apikey = IDM.create_apikey(device_type)
-                is_service_exist = False
-                for service in services['services']:
-                    if service['apikey'] == apikey:
-                        is_service_exist = True
-                if not is_service_exist:
-                    iotagent.create_service(apikey, device_type)
+                iotagent.ensure_service(IDM.create_apikey(device_type), device_type)
 
                 device = formservice.create_iotdevice(device_type, params, datamodel)
 
@@ -383,6 +559,32 @@ def create_app(entirety_config, client_secret):
 
         return render_template('form_generator.html', form=form(), action='Register', fiware_service='IoT Agent')
 
+    @app.route('/iotagent/bulk_import', methods=['GET', 'POST'])
+    @oidc.require_login
+    @check_orion
+    @check_iotagent
+    @check_keycloak
+    def iotagent_bulk_import():
+        """Queue job provisioning devices from uploaded CSV or JSONL file"""
+        form = TypesForm(request.form)
+        form.types.choices = [(t, t.split('.')[0],) for t in datamodel.iotdevice_types]
+
+        if request.method == 'POST':
+            device_type = request.form.get('types')
+            upload = request.files.get('file')
+            if device_type not in datamodel.iotdevice_types:
+                return jsonify({'error': 'Unknown device type {}'.format(device_type)}), 400
+            if upload is None or not upload.filename:
+                return jsonify({'error': 'File is required'}), 400
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+            try:
+                rows = list(bulk.read_rows(stream, upload.filename))
+            except (ValueError, csv.Error) as e:
+                return jsonify({'error': 'Could not read file: {}'.format(e)}), 400
+            return job_response(jobs.submit('bulk_import', device_type=device_type, rows=rows))
+
+        return render_template('iotagent/bulk_import.html', form=form)
+
     @app.route('/iotagent/devices', methods=['GET', 'POST'])
     @oidc.require_login
     @check_iotagent
@@ -395,11 +597,24 @@ def create_app(entirety_config, client_secret):
     @oidc.require_login
     def get_iotagent_devices_json():
         """Render IoT Agent devices as JSON"""
-        devices = iotagent.get_entities()
-        for device in devices['devices']:
-            device['mqtt_topic'] = idm.create_topic(device['entity_name'], device['entity_type'])
-            device['mqtt_user'] = device['entity_name'].lower()
-        return render_template('iotagent/devices_to_json.html', devices=devices)
+        query = DataTablesQuery(request.args)
+
+        partial = False
+        if query.search:
+            # the IoT Agent cannot search, scan the first max_scan devices only
+            total = iotagent.get_devices_page(0, 1)[1]
+            devices, filtered = query.filter(iotagent.iter_devices(max_items=query.max_scan),
+                                             lambda d: query.matches(d['entity_name'], d['entity_type']))
+            partial = total is not None and total > query.max_scan
+        else:
+            devices, total = query.fetch(iotagent.get_devices_page)
+            filtered = total
+
+        data = ([device['entity_name'],
+                 device['entity_type'],
+                 device['entity_name'].lower(),
+                 idm.create_topic(device['entity_name'], device['entity_type'])] for device in devices)
+        return stream_json(data, envelope=query.response(None, total, filtered, partial))
 
     @app.route('/iotagent/services', methods=['GET', 'POST'])
     @oidc.require_login
@@ -412,8 +627,9 @@ def create_app(entirety_config, client_secret):
     @oidc.require_login
     def get_iotagent_services_json():
         """Render IoT Agent services as JSON"""
-        services = iotagent.get_services()
-        return render_template('iotagent/services_to_json.html', services=services)
+        data = ([service['entity_type'], service['apikey'], service['resource']]
+                for service in iotagent.iter_services())
+        return stream_json(data, envelope={})
 
     @app.route('/iotagent/delete_service', methods=['GET'])
     @oidc.require_login
@@ -436,6 +652,37 @@ def create_app(entirety_config, client_secret):
         idm.delete_entity(device_id)
         return "true"
 
+    @app.route('/iotagent/delete_devices', methods=['POST'])
+    @oidc.require_login
+    @check_iotagent
+    @check_keycloak
+    def iotagent_delete_devices():
+        """Queue job deleting devices from IoT Agent and their users"""
+        return delete_job_response('delete_iotagent_devices', requested_ids())
+
+    # Job routes
+    @app.route('/jobs', methods=['GET'])
+    @oidc.require_login
+    def get_jobs():
+        """Return latest jobs as JSON"""
+        return jsonify({'jobs': jobs.list()})
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    @oidc.require_login
+    def get_job(job_id):
+        """Return status, progress and result of the job as JSON"""
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job {} not found'.format(job_id)}), 404
+        job.pop('params')
+        return jsonify(job)
+
+    @app.route('/jobs/<job_id>/view', methods=['GET'])
+    @oidc.require_login
+    def view_job(job_id):
+        """Render page polling the job until it has finished"""
+        return render_template('jobs/job.html', job_id=job_id)
+
     return app
 
 
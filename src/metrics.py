@@ -0,0 +1,137 @@
+"""Prometheus metrics of the upstream calls, routes and caches.
+
+uwsgi runs several worker processes, so the metrics are kept in the multiprocess mode of the
+Prometheus client when the ``PROMETHEUS_MULTIPROC_DIR`` environment variable points to a directory
+shared by the workers. It has to be set before the application is imported and emptied whenever
+uwsgi is started. Without it the metrics of the current process are exposed.
+"""
+
+import atexit
+import functools
+import inspect
+import threading
+import time
+
+import os
+from flask import g, request
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REGISTRY, \
+    generate_latest, multiprocess
+
+import timing
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+UPSTREAM_LATENCY = Histogram('entirety_upstream_request_seconds', 'Latency of HTTP requests to the upstream services',
+                             ['service', 'operation', 'method', 'status'])
+UPSTREAM_ERRORS = Counter('entirety_upstream_errors_total',
+                          'Upstream HTTP requests which failed without response or with a 5xx status',
+                          ['service', 'operation'])
+UPSTREAM_IN_FLIGHT = Gauge('entirety_upstream_in_flight', 'Upstream HTTP requests waiting for a response',
+                           ['service'], multiprocess_mode='livesum')
+CALL_LATENCY = Histogram('entirety_client_call_seconds',
+                         'Duration of the client methods including all their upstream requests',
+                         ['service', 'operation'])
+CALL_ERRORS = Counter('entirety_client_errors_total', 'Client methods which raised an exception',
+                      ['service', 'operation', 'exception'])
+CALL_IN_FLIGHT = Gauge('entirety_client_in_flight', 'Running client methods', ['service', 'operation'],
+                       multiprocess_mode='livesum')
+ROUTE_LATENCY = Histogram('entirety_http_request_seconds', 'Time until the response of a route was returned',
+                          ['endpoint', 'method', 'status'])
+CACHE_HITS = Counter('entirety_cache_hits_total', 'Lookups served from a cache', ['cache'])
+CACHE_MISSES = Counter('entirety_cache_misses_total', 'Lookups missing or expired in a cache', ['cache'])
+
+_local = threading.local()
+
+
+def current_operation():
+    """Return name of the innermost instrumented client method running in this thread"""
+    return getattr(_local, 'operation', '')
+
+
+def status_class(status_code):
+    return '{}xx'.format(status_code // 100)
+
+
+def record_cache(cache, hit):
+    if cache:
+        (CACHE_HITS if hit else CACHE_MISSES).labels(cache).inc()
+
+
+def _wrap(service, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        in_flight = CALL_IN_FLIGHT.labels(service, name)
+        previous = current_operation()
+        _local.operation = name
+        start = time.time()
+        in_flight.inc()
+        try:
+            with timing.span(service):
+                return func(*args, **kwargs)
+        except Exception as e:
+            CALL_ERRORS.labels(service, name, type(e).__name__).inc()
+            raise
+        finally:
+            in_flight.dec()
+            CALL_LATENCY.labels(service, name).observe(time.time() - start)
+            _local.operation = previous
+
+    return wrapper
+
+
+def instrument(cls):
+    """Class decorator timing the public methods of an upstream client, also as request span.
+
+    Static methods, properties and iterators (generators and ``iter_*`` methods, whose pages are
+    timed instead) are left alone, names listed in the ``uninstrumented`` class attribute as well.
+    The service label is the ``name`` attribute of the client class.
+    """
+    service = getattr(cls, 'name', cls.__name__.lower())
+    skip = set(getattr(cls, 'uninstrumented', ()))
+    for name, value in list(vars(cls).items()):
+        if name.startswith(('_', 'iter_')) or name in skip or not inspect.isfunction(value) \
+                or inspect.isgeneratorfunction(value):
+            continue
+        setattr(cls, name, _wrap(service, name, value))
+    return cls
+
+
+def init_app(app):
+    """Time the routes of the Flask app"""
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.time()
+
+    @app.after_request
+    def observe_route(response):
+        start = g.get('request_started')
+        if start is None:
+            return response
+        labels = ROUTE_LATENCY.labels(request.endpoint or 'none', request.method, status_class(response.status_code))
+        if response.is_streamed:
+            # the body is generated after this hook, time the route until it was sent
+            response.call_on_close(lambda: labels.observe(time.time() - start))
+        else:
+            labels.observe(time.time() - start)
+        return response
+
+
+def multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+def generate():
+    """Return metrics of all workers in the Prometheus text format"""
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+@atexit.register
+def _mark_process_dead():
+    """Drop the live gauges of a stopped worker"""
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,59 @@
+import itertools
+import json
+
+from flask import Response, stream_with_context
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_json(items, envelope=None, key='data'):
+    """Encode items as JSON array, wrapped in the envelope object under key unless envelope is None.
+
+    Items are encoded one by one as they come from the iterator and written in chunks of about
+    CHUNK_SIZE bytes, so the memory used does not depend on the number of items.
+    """
+    if envelope is None:
+        head, tail = b'[', b']'
+    elif any(k != key for k in envelope):
+        fields = {k: v for k, v in envelope.items() if k != key}
+        head, tail = dumps(fields)[:-1] + b',' + dumps(key) + b':[', b']}'
+    else:
+        head, tail = b'{' + dumps(key) + b':[', b']}'
+
+    chunk = [head]
+    size = len(head)
+    separator = b''
+    for item in items:
+        data = separator + dumps(item)
+        separator = b','
+        chunk.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(tail)
+    yield b''.join(chunk)
+
+
+def stream_json(items, envelope=None, key='data'):
+    """Return response streaming items from the iterator as JSON.
+
+    The first item is taken before the response is returned, so an upstream error while fetching
+    the first page is raised by the view and answered with an error status, not a truncated body.
+    """
+    items = iter(items)
+    first = list(itertools.islice(items, 1))
+    return Response(stream_with_context(iter_json(itertools.chain(first, items), envelope, key)),
+                    mimetype='application/json')
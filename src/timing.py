@@ -0,0 +1,174 @@
+import cProfile
+import functools
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import os
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+_local = threading.local()
+
+
+class Timing(object):
+    """Time spent in the parts of one request, emitted as ``Server-Timing`` header.
+
+    Spans are exclusive: time of a span started inside another one, e.g. the Datamodel lookups of
+    a form, is not counted again for the outer span. A span nested in one of the same name is
+    merged into it. Spans of calls run concurrently on other threads are added up, so their sum
+    can exceed the total.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = {}
+        self._stacks = {}
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        return self._stacks.setdefault(threading.get_ident(), [])
+
+    def start(self, name):
+        """Start span in the current thread, return False if a span of the name is running"""
+        stack = self._stack()
+        if any(entry[0] == name for entry in stack):
+            return False
+        stack.append([name, time.time(), 0.0])
+        return True
+
+    def stop(self, name):
+        stack = self._stack()
+        if not stack or stack[-1][0] != name:
+            return
+        _, started, nested = stack.pop()
+        duration = time.time() - started
+        if stack:
+            stack[-1][2] += duration
+        with self._lock:
+            total, count = self.spans.get(name, (0.0, 0))
+            self.spans[name] = (total + duration - nested, count + 1)
+
+    def header(self):
+        spans = ['{};dur={:.1f};desc="{} calls"'.format(name, total * 1000, count)
+                 for name, (total, count) in sorted(self.spans.items())]
+        spans.append('total;dur={:.1f}'.format((time.time() - self.started) * 1000))
+        return ', '.join(spans)
+
+
+def current():
+    """Return Timing of the request handled by this thread or None"""
+    timing = getattr(_local, 'timing', None)
+    if timing is None and has_request_context():
+        timing = g.get('timing')
+    return timing
+
+
+@contextmanager
+def span(name):
+    timing = current()
+    started = timing is not None and timing.start(name)
+    try:
+        yield
+    finally:
+        if started:
+            timing.stop(name)
+
+
+def timed(name):
+    """Decorator recording calls of the function as span of the name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(func):
+    """Wrap func, so spans recorded while it runs on another thread belong to the current request"""
+    timing = current()
+    if timing is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'timing', None)
+        _local.timing = timing
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timing = previous
+    return wrapper
+
+
+def init_app(app, enabled=True):
+    """Record spans of each request and add the Server-Timing header to the response"""
+    if not enabled:
+        return
+
+    @app.before_request
+    def start_timing():
+        g.timing = Timing()
+
+    @app.after_request
+    def add_server_timing(response):
+        timing = g.get('timing')
+        if timing is not None:
+            response.headers['Server-Timing'] = timing.header()
+        return response
+
+    def render_started(sender, template, context, **extra):
+        timing = current()
+        if timing is not None:
+            timing.start('render')
+
+    def render_finished(sender, template, context, **extra):
+        timing = current()
+        if timing is not None:
+            timing.stop('render')
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+
+class Profiler(object):
+    """Run requests of admins under cProfile when they ask for it.
+
+    A request is profiled if it has the ``profile`` query parameter or the ``X-Profile`` header and
+    the user is one of ``admins``. The profile is saved as ``<path>/<time>-<endpoint>-<id>.prof``,
+    e.g. for ``python -m pstats`` or snakeviz, its file name is returned in the ``X-Profile`` header.
+    """
+    path = 'profiles'
+    admins = []
+
+    def __init__(self, config={}):
+        self.path = config.get('profile_dir', self.path)
+        self.admins = config.get('admins', self.admins)
+
+    def requested(self, user):
+        return user is not None and user in self.admins and \
+            ('profile' in request.args or 'X-Profile' in request.headers)
+
+    def start(self):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+    def stop(self, response):
+        """Stop profiling the request and save the profile"""
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        profile.disable()
+        filename = '{}-{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'), request.endpoint or 'none',
+                                          uuid.uuid4().hex[:8])
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            profile.dump_stats(os.path.join(self.path, filename))
+        except OSError as e:
+            logging.error('Could not save profile {}: {}'.format(filename, e))
+            return response
+        response.headers['X-Profile'] = filename
+        return response
@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from flask import Flask, g
+
+from auth import CachedOpenIDConnect
+
+
+class IDMHandler(BaseHTTPRequestHandler):
+    calls = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.calls.append(self.path)
+        if self.path == '/userinfo':
+            body = {'sub': '1', 'preferred_username': 'admin'}
+        else:
+            body = {'active': True, 'scope': 'openid', 'exp': time.time() + 3600}
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def idm():
+    server = HTTPServer(('127.0.0.1', 0), IDMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    IDMHandler.calls = []
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+
+
+@pytest.fixture
+def app(idm, tmp_path):
+    secrets = tmp_path / 'client_secrets.json'
+    secrets.write_text(json.dumps({'web': {
+        'client_id': 'entirety', 'client_secret': 'secret', 'auth_uri': idm + '/auth', 'token_uri': idm + '/token',
+        'userinfo_uri': idm + '/userinfo', 'token_introspection_uri': idm + '/introspect',
+        'redirect_uris': ['http://localhost/oidc_callback']}}))
+    app = Flask(__name__)
+    app.config.update({'SECRET_KEY': 'test', 'OIDC_CLIENT_SECRETS': str(secrets),
+                       'OIDC_INTROSPECTION_AUTH_METHOD': 'client_secret_post'})
+    return app
+
+
+def test_userinfo_cached(app):
+    oidc = CachedOpenIDConnect(app)
+    for _ in range(3):
+        with app.test_request_context('/'):
+            g.oidc_id_token = None
+            assert oidc.user_getinfo(['preferred_username'], access_token='token') == {'preferred_username': 'admin'}
+    assert IDMHandler.calls == ['/userinfo']
+    assert oidc.cache_stats()['userinfo'] == {'hits': 2, 'misses': 1, 'size': 1}
+
+
+def test_introspection_cached(app):
+    oidc = CachedOpenIDConnect(app, config={'introspection_ttl': 0.2})
+    with app.test_request_context('/'):
+        assert oidc.validate_token('token', ['openid']) is True
+        assert oidc.validate_token('token', ['openid']) is True
+        time.sleep(0.3)
+        assert oidc.validate_token('token', ['openid']) is True
+    assert IDMHandler.calls == ['/introspect', '/introspect']
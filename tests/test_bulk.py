@@ -0,0 +1,136 @@
+import io
+
+import pytest
+
+from bulk import BulkImporter, BulkDeleter
+from datamodel import Datamodel
+from fanout import FanOut
+from forms import FormService
+
+
+class Reply(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+class IoTAgent(object):
+    """Registers the new devices of a batch even if it rejects the batch, like the IoT Agent"""
+
+    def __init__(self, existing):
+        self.devices = set(existing)
+
+    def create_devices(self, devices):
+        ids = [device['device_id'] for device in devices]
+        duplicates = self.devices.intersection(ids)
+        self.devices.update(ids)
+        if duplicates:
+            return Reply(409, {'name': 'DUPLICATE_DEVICE_ID', 'message': 'Duplicate device'})
+        return Reply(201, {})
+
+    def delete_entity(self, device_id):
+        if device_id.startswith('broken'):
+            return Reply(500, {'name': 'INTERNAL_ERROR', 'message': 'Could not delete'})
+        if device_id not in self.devices:
+            return Reply(404, {'name': 'DEVICE_NOT_FOUND', 'message': 'No device'})
+        self.devices.remove(device_id)
+        return Reply(204, None)
+
+
+class Orion(object):
+    batch_size = 2
+
+    def __init__(self, existing):
+        self.entities = set(existing)
+
+    def batch_delete(self, ids):
+        report = []
+        for i in ids:
+            if i.startswith('broken'):
+                report.append({'id': i, 'status': 'failed', 'error': 'Internal error'})
+            elif i in self.entities:
+                self.entities.remove(i)
+                report.append({'id': i, 'status': 'deleted', 'error': None})
+            else:
+                report.append({'id': i, 'status': 'not_found', 'error': None})
+        return report
+
+
+class IDM(object):
+    def __init__(self, users):
+        self.users = set(users)
+
+    def entity_exists(self, device_id):
+        return device_id in self.users
+
+    def create_entity(self, device_id, device_type):
+        self.users.add(device_id)
+
+    def delete_entity(self, device_id):
+        if device_id not in self.users:
+            return False
+        self.users.remove(device_id)
+        return True
+
+
+@pytest.fixture
+def importer():
+    config = {
+        "ngsi2": "datamodel/NGSI2",
+        "ngsi-ld": "datamodel/NGSI-LD",
+        "classes": "datamodel/classes"
+    }
+    return BulkImporter(None, None, Datamodel(config), FormService())
+
+
+def test_read_rows():
+    csv = io.StringIO('device_id,hasChannel\nd1,c1\nd2,\n')
+    assert list(BulkImporter.read_rows(csv, 'devices.csv')) == [{'device_id': 'd1', 'hasChannel': 'c1'},
+                                                                 {'device_id': 'd2', 'hasChannel': ''}]
+    jsonl = io.StringIO('{"device_id": "d1"}\n\n{"device_id": "d2"}\n')
+    assert list(BulkImporter.read_rows(jsonl, 'devices.jsonl')) == [{'device_id': 'd1'}, {'device_id': 'd2'}]
+
+
+def test_validate(importer):
+    fields = importer.fields('Actuator.json')
+    row = {name: 'urn:ngsi-ld:Test:1' for name, required, query in fields}
+    row['device_id'] = 'a1'
+    reports = importer.validate('Actuator.json', [row, dict(row, hasChannel=''), row])
+
+    assert reports[0]['status'] == 'valid'
+    assert reports[0]['device']['device_id'] == 'urn:ngsi-ld:Actuator:a1'
+    assert reports[1]['errors'] == ['hasChannel is required', 'Duplicate device_id a1']
+    assert reports[2]['errors'] == ['Duplicate device_id a1']
+
+
+def test_partial_batch(importer):
+    fields = importer.fields('Actuator.json')
+    rows = []
+    for n in range(3):
+        row = {name: 'urn:ngsi-ld:Test:1' for name, required, query in fields}
+        row['device_id'] = 'a{}'.format(n)
+        rows.append(row)
+    reports = importer.validate('Actuator.json', rows)
+    existing = reports[1]['device']
+    importer.iotagent = IoTAgent([existing['device_id']])
+    importer.idm = IDM([existing['entity_name']])
+
+    importer.provision(reports)
+    assert [r['status'] for r in reports] == ['created', 'exists', 'created']
+    importer.register_users(reports)
+    assert importer.idm.users == {r['device']['entity_name'] for r in reports}
+
+
+def test_delete_keeps_users_of_failed_devices():
+    ids = ['d1', 'broken1', 'gone']
+    for delete in (BulkDeleter.delete_orion, BulkDeleter.delete_iotagent):
+        idm = IDM(ids)
+        deleter = BulkDeleter(Orion(['d1', 'broken1']), IoTAgent(['d1', 'broken1']), idm, FanOut())
+        report = delete(deleter, ids)
+        assert [(r['status'], r['user']) for r in report] == [('deleted', 'deleted'), ('failed', 'skipped'),
+                                                              ('not_found', 'deleted')]
+        assert idm.users == {'broken1'}
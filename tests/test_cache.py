@@ -0,0 +1,40 @@
+import time
+
+from cache import TTLCache
+
+
+def test_expire():
+    cache = TTLCache(ttl=0.1)
+    cache.set('Sensor', ['urn:ngsi-ld:Sensor:1'])
+    assert cache.get('Sensor') == ['urn:ngsi-ld:Sensor:1']
+    time.sleep(0.2)
+    assert cache.get('Sensor') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_maxsize():
+    cache = TTLCache(ttl=10, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+
+def test_clear():
+    cache = TTLCache()
+    cache.set('a', 1)
+    cache.clear()
+    assert cache.get('a') is None
+
+
+def test_entry_ttl():
+    cache = TTLCache(ttl=10)
+    cache.set('a', 1, ttl=0.1)
+    cache.set('b', 2, ttl=-1)
+    time.sleep(0.2)
+    assert cache.get('a') is None
+    assert cache.get('b') is None
+    assert cache.stats() == {'hits': 0, 'misses': 2, 'size': 0}
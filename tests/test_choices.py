@@ -0,0 +1,89 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from choices import ChoiceProvider, IdIndex
+from fiware import Orion
+
+
+class OrionHandler(BaseHTTPRequestHandler):
+    entities = []
+    reject_pick = False
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        if ' ' in params.get('type', '') or (self.reject_pick and 'pick' in params):
+            detail = 'pick' if 'pick' in params and self.reject_pick else 'type'
+            return self.reply(400, {'title': 'Invalid URI parameter', 'detail': detail})
+        types = params.get('type', '').split(',')
+        pattern = re.compile(params.get('idPattern', ''))
+        matched = [{'id': i, 'type': t} for i, t in self.entities if t in types and pattern.search(i)]
+        limit = int(params.get('limit', 20))
+        headers = {'NGSILD-Results-Count': str(len(matched))} if params.get('count') == 'true' else {}
+        self.reply(200, matched[int(params.get('offset', 0)):][:limit], headers)
+
+    def reply(self, status, body, headers={}):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def orion():
+    server = HTTPServer(('127.0.0.1', 0), OrionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    OrionHandler.entities = [('urn:ngsi-ld:Channel:c1', 'Channel')]
+    OrionHandler.reject_pick = False
+    yield Orion({'orion': 'http://127.0.0.1:{}'.format(server.server_port)})
+    server.shutdown()
+
+
+def test_search_names():
+    ids = ['urn:ngsi-ld:Channel:{}'.format(name) for name in ['b2', 'A1', 'a3', 'c1', 'ab']]
+    index = IdIndex('Channel', ids)
+    assert index.search('a') == (['urn:ngsi-ld:Channel:A1', 'urn:ngsi-ld:Channel:a3',
+                                  'urn:ngsi-ld:Channel:ab'], 3)
+    assert index.search('a', offset=1, limit=1) == (['urn:ngsi-ld:Channel:a3'], 3)
+    assert index.search('d') == ([], 0)
+    assert index.search('', limit=2) == (sorted(ids)[:2], 5)
+
+
+def test_search_ids():
+    ids = ['urn:ngsi-ld:Channel:c1', 'urn:ngsi-ld:Sensor:s1']
+    index = IdIndex('Channel', ids)
+    assert index.search('urn:ngsi-ld:S') == (['urn:ngsi-ld:Sensor:s1'], 1)
+    assert index.search('c') == (['urn:ngsi-ld:Channel:c1'], 1)
+    assert 'urn:ngsi-ld:Channel:c1' in index
+    assert 'urn:ngsi-ld:Channel:c2' not in index
+
+
+def test_contains_checks_type(orion):
+    choices = ChoiceProvider(orion)
+    assert choices.contains('Channel', 'urn:ngsi-ld:Channel:c1')
+    OrionHandler.entities += [('urn:ngsi-ld:Channel:c2', 'Channel'), ('urn:ngsi-ld:Sensor:s1', 'Sensor')]
+    assert choices.contains('Channel', 'urn:ngsi-ld:Channel:c2')
+    assert not choices.contains('Channel', 'urn:ngsi-ld:Sensor:s1')
+    assert not choices.contains('Channel', 'urn:ngsi-ld:Channel:c')
+
+
+def test_pick_fallback(orion):
+    with pytest.raises(requests.exceptions.HTTPError):
+        orion.get_entity_ids_page(['Bad type'])
+    assert orion.pick_supported
+    OrionHandler.reject_pick = True
+    assert orion.get_entity_ids_page(['Channel']) == [('urn:ngsi-ld:Channel:c1', 'Channel')]
+    assert not orion.pick_supported
+    assert Orion.pick_supported
@@ -1,4 +1,6 @@
 import datetime
+import os
+import shutil
 import string
 
 import pytest
@@ -55,3 +57,74 @@ def test_create_iotdevice_from_json(datamodel):
     for file in datamodel.iotdevice_types:
         datamodel.create_iotdevice_from_json(file)
         # TODO: JSON validation
+
+
+def test_properties_index(datamodel):
+    for file in datamodel.device_types:
+        properties = datamodel.get_properties_dict(file)
+        assert properties is datamodel.get_properties_dict(file)
+        assert properties['id'].property == 'id_0_id_string_req'
+        assert len(set(datamodel.get_variables(file))) == len(properties)
+
+
+def test_properties_index_reload(tmp_path):
+    shutil.copytree('datamodel', str(tmp_path / 'datamodel'))
+    datamodel = Datamodel({
+        "ngsi2": str(tmp_path / "datamodel/NGSI2"),
+        "ngsi-ld": str(tmp_path / "datamodel/NGSI-LD"),
+        "classes": str(tmp_path / "datamodel/classes"),
+        "poll_interval": 0
+    })
+    sensor = datamodel.get_properties_dict('Sensor.template')
+
+    shutil.copy(str(tmp_path / 'datamodel/NGSI-LD/Sensor.template'), str(tmp_path / 'datamodel/NGSI-LD/Probe.template'))
+    assert 'Probe.template' in datamodel.device_types
+    assert datamodel.get_properties_dict('Sensor.template') is sensor
+
+    base = tmp_path / 'datamodel/NGSI-LD/base/Device.template'
+    base.write_text(base.read_text() + '{{ location_99_Location_string_opt }}')
+    os.utime(str(base), (0, 0))
+    assert 'location' in datamodel.get_properties_dict('Sensor.template')
+    assert 'location' in datamodel.get_properties_dict('Probe.template')
+
+
+def test_iotdevice_definition_cached(datamodel):
+    definition = datamodel.get_iotdevice_definition('Sensor.json')
+    assert datamodel.get_iotdevice_definition('Sensor.json') is definition
+    with pytest.raises(TypeError):
+        definition['entity_type'] = 'Changed'
+
+    device = datamodel.create_iotdevice_from_json('Sensor.json')
+    device['static_attributes'].append({'name': 'changed'})
+    device['entity_type'] = 'Changed'
+    assert datamodel.get_iotdevice_definition('Sensor.json')['entity_type'] == 'Sensor'
+    assert len(datamodel.create_iotdevice_from_json('Sensor.json')['static_attributes']) == \
+        len(definition['static_attributes'])
+    assert 'base_template' not in device
+
+
+def test_iotdevice_definition_reload(tmp_path):
+    shutil.copytree('datamodel', str(tmp_path / 'datamodel'))
+    datamodel = Datamodel({
+        "ngsi2": str(tmp_path / "datamodel/NGSI2"),
+        "ngsi-ld": str(tmp_path / "datamodel/NGSI-LD"),
+        "classes": str(tmp_path / "datamodel/classes")
+    })
+    definition = datamodel.get_iotdevice_definition('Sensor.json')
+
+    base = tmp_path / 'datamodel/NGSI2/base/Device.json'
+    base.write_text(base.read_text().replace('"timezone": ""', '"timezone": "UTC"'))
+    os.utime(str(base), (0, 0))
+    assert definition['timezone'] == ''
+    assert datamodel.get_iotdevice_definition('Sensor.json')['timezone'] == 'UTC'
+
+    shutil.copy(str(tmp_path / 'datamodel/NGSI2/Sensor.json'), str(tmp_path / 'datamodel/NGSI2/Probe.json'))
+    os.utime(str(tmp_path / 'datamodel/NGSI2'), (0, 0))
+    assert 'Probe.json' in datamodel.iotdevice_types
+
+
+def test_class_entities(datamodel):
+    entities = datamodel.get_class_entities()
+    assert len(entities) == len(datamodel.classes_file_list)
+    assert all(e['id'].startswith('urn:ngsi-ld:') for e in entities)
+    assert datamodel.get_class_entities()[0] is entities[0]
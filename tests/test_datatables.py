@@ -0,0 +1,55 @@
+import pytest
+
+from datatables import DataTablesQuery
+
+ITEMS = list(range(25))
+
+
+def get_page(offset, limit):
+    return ITEMS[offset:offset + limit], len(ITEMS)
+
+
+def query(**kwargs):
+    args = {'draw': '3', 'start': '0', 'length': '10', 'search[value]': '', 'order[0][dir]': 'asc'}
+    args.update(kwargs)
+    return DataTablesQuery(args)
+
+
+def test_parse_arguments():
+    q = query(start='20', length='-1', **{'search[value]': ' Sensor '})
+    assert q.draw == 3
+    assert q.start == 20
+    assert q.length == DataTablesQuery.max_length
+    assert q.search == 'Sensor'
+    assert q.id_pattern == '.*Sensor.*'
+    assert DataTablesQuery({}).length == 10
+
+
+@pytest.mark.parametrize('start, direction, expected', [
+    ('0', 'asc', list(range(10))),
+    ('20', 'asc', list(range(20, 25))),
+    ('0', 'desc', list(range(24, 14, -1))),
+    ('20', 'desc', list(range(4, -1, -1))),
+    ('30', 'desc', []),
+])
+def test_fetch(start, direction, expected):
+    items, total = query(start=start, **{'order[0][dir]': direction}).fetch(get_page)
+    assert items == expected
+    assert total == 25
+
+
+@pytest.mark.parametrize('direction, expected', [
+    ('asc', [5, 7]),
+    ('desc', [19, 17]),
+])
+def test_filter(direction, expected):
+    q = query(start='2', length='2', **{'order[0][dir]': direction})
+    items, matched = q.filter(iter(ITEMS), lambda i: i % 2)
+    assert items == expected
+    assert matched == 12
+
+
+def test_response():
+    response = query().response(['a'], 10, 1)
+    assert response == {'draw': 3, 'recordsTotal': 10, 'recordsFiltered': 1, 'data': ['a']}
+    assert query().response(['a'], 10, 1, partial=True)['partial'] is True
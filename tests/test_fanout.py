@@ -0,0 +1,29 @@
+import time
+
+import pytest
+
+from fanout import FanOut
+
+
+@pytest.fixture
+def fanout():
+    return FanOut(config={'max_workers': 4, 'deadline': 0.5})
+
+
+def test_run_concurrently(fanout):
+    calls = {'call_{}'.format(i): lambda: time.sleep(0.2) or 1 for i in range(4)}
+    start = time.time()
+    results, missing = fanout.run(calls)
+    assert time.time() - start < 0.6
+    assert missing == []
+    assert sum(results.values()) == 4
+
+
+def test_missing_calls(fanout):
+    def fail():
+        raise ValueError('failed')
+
+    calls = {'fast': lambda: 'ok', 'slow': lambda: time.sleep(1), 'failed': fail}
+    results, missing = fanout.run(calls, deadline=0.2)
+    assert results == {'fast': 'ok'}
+    assert sorted(missing) == ['failed', 'slow']
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from health import HealthMonitor
+
+
+@pytest.fixture
+def health():
+    monitor = HealthMonitor(config={'interval': 0.05, 'ttl': 60})
+    monitor.calls = {'up': 0, 'down': 0}
+
+    def up():
+        monitor.calls['up'] += 1
+        return '1.0.0'
+
+    def down():
+        monitor.calls['down'] += 1
+        raise ConnectionError('refused')
+
+    monitor.register('up', up, 'http://up')
+    monitor.register('down', down, 'http://down')
+    yield monitor
+    monitor.stop()
+
+
+def test_status_is_cached(health):
+    assert health.is_active('up')
+    assert health.version('up') == '1.0.0'
+    assert health.is_active('up')
+    assert health.calls['up'] == 1
+
+
+def test_failed_probe(health):
+    status = health.status('down')
+    assert not status['active']
+    assert status['version'] == ''
+    assert 'refused' in status['error']
+    assert health.to_dict(details=False)['services']['down'] == {'active': False}
+    assert health.to_dict()['services']['down']['error'] == status['error']
+
+
+def test_stale_status_is_probed(health):
+    health.status('up')
+    health.ttl = 0
+    time.sleep(0.01)
+    health.status('up')
+    assert health.calls['up'] == 2
+
+
+def test_background_probing(health):
+    health.start()
+    time.sleep(0.2)
+    assert health.calls['up'] > 1
+
+
+def test_to_dict(health):
+    result = health.to_dict()
+    assert result['status'] == 'degraded'
+    assert set(result['services']) == {'up', 'down'}
+    assert result['services']['up']['latency'] >= 0
@@ -74,3 +74,14 @@ def test_create_entity(idm, datamodel, orion, docker_keycloack):
             [random.choice(string.ascii_letters + string.digits) for n in range(32)]))
         idm.create_entity(device_id, device_type)
         idm.delete_entity(device_id)
+
+
+def test_keycloak_client_cached(idm, docker_keycloack):
+    keycloak = idm._get_keycloack()
+    assert idm._get_keycloack() is keycloak
+    access_token = keycloak.token['access_token']
+
+    idm._expires_at = 0
+    assert idm._get_keycloack() is keycloak
+    assert keycloak.token['access_token'] != access_token
+    assert idm.is_active()
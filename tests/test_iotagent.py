@@ -5,6 +5,7 @@ import pytest
 import random
 from wtforms import DateTimeField, StringField, SelectField
 
+from bulk import BulkImporter
 from datamodel import Datamodel
 from fiware import Orion, IoTAgent
 from forms import FormService
@@ -88,6 +89,63 @@ def test_iotagent_create_all_entity(iotagent, datamodel, orion, docker_orion, do
         r = iotagent.delete_entity(device_id)
         assert r.status_code == 204
 
+def test_iter_devices(iotagent, docker_iotagent):
+    devices, count = iotagent.get_devices_page(0, 5)
+    assert len(devices) == min(5, count)
+    devices = list(iotagent.iter_devices(page_size=2))
+    assert len(devices) == count
+    for device in devices:
+        typed = list(iotagent.iter_devices(entity_type=device['entity_type'], page_size=2))
+        assert all(d['entity_type'] == device['entity_type'] for d in typed)
+        assert device['device_id'] in [d['device_id'] for d in typed]
+        page = iotagent.get_entities(limit=len(typed) + 1, entity_type=device['entity_type'])
+        assert page['count'] == len(typed)
+        page = iotagent.get_entities(limit=1, entity_type=device['entity_type'])
+        assert page['count'] is None
+        assert len(page['devices']) == 1
+
+
+def test_iter_services(iotagent, docker_iotagent):
+    services, count = iotagent.get_services_page(0, 5)
+    assert len(services) == min(5, count)
+    assert len(list(iotagent.iter_services(page_size=2))) == count
+    assert iotagent.get_services()['count'] == count
+
+
+def test_service_registry(iotagent, docker_iotagent):
+    apikey = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(16)])
+    assert iotagent.get_service(apikey) is None
+    assert iotagent.ensure_service(apikey, 'Sensor.json')['status']
+    assert iotagent.get_service(apikey)['entity_type'] == 'Sensor'
+
+    other = IoTAgent({'iotagent': 'http://localhost:4041', 'orion': 'http://localhost:1026'})
+    other.get_service(apikey)
+    other._services.pop(apikey)
+    assert other.ensure_service(apikey, 'Sensor.json')['status']
+
+    iotagent.delete_service(apikey, '/iot/d')
+    assert iotagent.get_service(apikey) is None
+
+
+def test_bulk_provision(iotagent, datamodel, orion, docker_orion, docker_iotagent):
+    importer = BulkImporter(iotagent, None, datamodel, FormService(), config={'batch_size': 2})
+    rows = []
+    for n in range(3):
+        row = {name: 'urn:ngsi-ld:Test:{}'.format(n) for name, required, query in importer.fields('Sensor.json')}
+        row['device_id'] = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        rows.append(row)
+    reports = importer.validate('Sensor.json', rows)
+    assert importer.ensure_service('Sensor.json')['status']
+    importer.provision(reports)
+    assert [r['status'] for r in reports] == ['created'] * 3
+
+    reports = importer.validate('Sensor.json', rows[:1])
+    importer.provision(reports)
+    assert reports[0]['status'] == 'exists'
+    for row in rows:
+        iotagent.delete_entity('urn:ngsi-ld:Sensor:{}'.format(row['device_id']))
+
+
 def test_get_version(iotagent, docker_orion):
     version = iotagent.get_version()
     assert len(version) > 0
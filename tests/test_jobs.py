@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from jobs import JobRunner
+
+
+def wait(runner, job_id, timeout=5):
+    start = time.time()
+    while time.time() - start < timeout:
+        job = runner.get(job_id)
+        if job['status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('Job {} did not finish'.format(job_id))
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = JobRunner(config={'path': str(tmp_path / 'jobs.sqlite'), 'stale': 1})
+
+    def count(job, items):
+        for n, item in enumerate(items, start=1):
+            job.progress(n, len(items), 'Item {}'.format(item))
+        return {'count': len(items)}
+
+    def fail(job):
+        raise ValueError('failed')
+
+    runner.register('count', count)
+    runner.register('fail', fail)
+    return runner
+
+
+def test_run(runner):
+    job = wait(runner, runner.submit('count', items=[1, 2, 3]))
+    assert job['status'] == 'succeeded'
+    assert job['result'] == {'count': 3}
+    assert (job['done'], job['total'], job['message']) == (3, 3, 'Item 3')
+    assert job['params'] == {'items': [1, 2, 3]}
+
+
+def test_failed(runner):
+    job = wait(runner, runner.submit('fail'))
+    assert job['status'] == 'failed'
+    assert job['error'] == 'failed'
+
+
+def test_unknown_kind(runner):
+    with pytest.raises(ValueError):
+        runner.submit('unknown')
+
+
+def test_recover(runner, tmp_path):
+    job_id = runner.submit('count', items=[1])
+    wait(runner, job_id)
+    runner.update(job_id, status='running', heartbeat=time.time() - 10, attempts=1)
+
+    restarted = JobRunner(config={'path': str(tmp_path / 'jobs.sqlite'), 'stale': 1})
+    restarted.register('count', runner._kinds['count'])
+    restarted.recover()
+    job = restarted.get(job_id)
+    assert job['status'] == 'succeeded'
+    assert job['attempts'] == 2
+
+    restarted.update(job_id, status='running', heartbeat=time.time() - 10, attempts=3)
+    restarted.recover()
+    assert restarted.get(job_id)['status'] == 'failed'
+    assert [j['id'] for j in restarted.list()] == [job_id]
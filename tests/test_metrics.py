@@ -0,0 +1,84 @@
+import pytest
+from flask import Flask
+from prometheus_client import REGISTRY
+
+import metrics
+from cache import TTLCache
+from datamodel import Datamodel
+
+
+@metrics.instrument
+class Client(object):
+    name = 'test'
+    uninstrumented = ('listener',)
+
+    def outer(self):
+        return self.inner()
+
+    def inner(self):
+        return metrics.current_operation()
+
+    def fail(self):
+        raise ValueError('failed')
+
+    def iter_items(self):
+        return iter([])
+
+    def listener(self):
+        pass
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_instrument():
+    client = Client()
+    calls = sample('entirety_client_call_seconds_count', service='test', operation='outer')
+    assert client.outer() == 'inner'
+    assert metrics.current_operation() == ''
+    assert sample('entirety_client_call_seconds_count', service='test', operation='outer') == calls + 1
+    with pytest.raises(ValueError):
+        client.fail()
+    assert sample('entirety_client_errors_total', service='test', operation='fail', exception='ValueError') >= 1
+    assert sample('entirety_client_in_flight', service='test', operation='fail') == 0
+    assert not hasattr(Client.iter_items, '__wrapped__')
+    assert not hasattr(Client.listener, '__wrapped__')
+
+
+def test_cache():
+    hits = sample('entirety_cache_hits_total', cache='test')
+    misses = sample('entirety_cache_misses_total', cache='test')
+    cache = TTLCache(name='test')
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    assert sample('entirety_cache_hits_total', cache='test') == hits + 1
+    assert sample('entirety_cache_misses_total', cache='test') == misses + 1
+
+
+def test_datamodel_caches():
+    datamodel = Datamodel({'ngsi2': 'datamodel/NGSI2', 'ngsi-ld': 'datamodel/NGSI-LD', 'classes': 'datamodel/classes'})
+    hits = {cache: sample('entirety_cache_hits_total', cache=cache)
+            for cache in ('device_schemas', 'iotdevice_definitions', 'class_entities')}
+    for _ in range(2):
+        datamodel.get_properties_dict(datamodel.device_types[0])
+        datamodel.get_iotdevice_definition(datamodel.iotdevice_types[0])
+        datamodel.get_class_entities()
+    for cache, before in hits.items():
+        assert sample('entirety_cache_hits_total', cache=cache) > before
+    assert sample('entirety_cache_misses_total', cache='device_schemas') >= len(datamodel.device_types)
+
+
+def test_routes():
+    app = Flask(__name__)
+    metrics.init_app(app)
+
+    @app.route('/metrics')
+    def get_metrics():
+        return metrics.generate()
+
+    client = app.test_client()
+    client.get('/metrics')
+    assert b'entirety_http_request_seconds_count{endpoint="get_metrics",method="GET",status="2xx"}' \
+        in client.get('/metrics').data
@@ -3,11 +3,12 @@ import string
 
 import pytest
 import random
-from wtforms import DateTimeField, StringField, SelectField
+from wtforms import DateTimeField, StringField
 
+from choices import ChoiceProvider
 from datamodel import Datamodel
 from fiware import Orion
-from forms import FormService
+from forms import FormService, SearchField
 
 pytest_plugins = ["docker_compose"]
 
@@ -57,10 +58,9 @@ def test_orion_create_all_entity(orion, datamodel, docker_orion):
         for field in entity_form:
             if isinstance(field, DateTimeField):
                 field.data = datetime.datetime.now()
-            if isinstance(field, SelectField):
-                field.data = field.choices[1]
-
-            if isinstance(field, StringField):
+            if isinstance(field, SearchField):
+                field.data = field.suggestions()[0]
+            elif isinstance(field, StringField):
                 field.data = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
 
             data = field.data
@@ -77,6 +77,57 @@ def test_orion_create_all_entity(orion, datamodel, docker_orion):
         r = orion.delete_entity(id)
         assert r.status_code == 204
 
+def test_form_class_cached(orion, datamodel, docker_orion):
+    formservice = FormService()
+    file = datamodel.device_types[0]
+    first, _ = formservice.create_form_template(file, orion, datamodel)
+    second, _ = formservice.create_form_template(file, orion, datamodel)
+    assert first.func is second.func
+    for field in second():
+        if isinstance(field, SearchField):
+            assert field.provider is formservice.choices
+
+
+def throwaway_entities(datamodel, count):
+    """Return copies of class entities with new ids, which tests may delete"""
+    return [dict(entity, id='{}-test'.format(entity['id'])) for entity in datamodel.get_class_entities()[:count]]
+
+
+def test_choices(orion, datamodel, docker_orion):
+    entity = throwaway_entities(datamodel, 1)[0]
+    orion.batch_create([entity])
+    choices = ChoiceProvider(orion)
+    classes = datamodel.get_classes()
+    ids = choices.get_ids(classes)
+    for c in classes:
+        assert sorted(ids[c]) == sorted(e['id'] for e in orion.get_entities(c))
+    assert choices.cache.get(entity['type']) is not None
+    assert choices.contains(entity['type'], entity['id'])
+    assert choices.search(entity['type'], entity['id']) == ([entity['id']], 1)
+    orion.delete_entity(entity['id'])
+    assert choices.cache.get(entity['type']) is None
+    assert not choices.contains(entity['type'], entity['id'])
+
+
+def test_batch_create(orion, datamodel, docker_orion):
+    entities = datamodel.get_class_entities()
+    report = orion.batch_create(entities, batch_size=10)
+    assert [r['id'] for r in report] == [e['id'] for e in entities]
+    assert all(r['status'] == 'exists' for r in report)
+    report = orion.batch_create(entities[:5], upsert=True)
+    assert all(r['status'] == 'updated' for r in report)
+
+
+def test_batch_delete(orion, datamodel, docker_orion):
+    entities = throwaway_entities(datamodel, 5)
+    orion.batch_create(entities)
+    ids = [e['id'] for e in entities]
+    report = orion.batch_delete(ids, batch_size=2)
+    assert [r['status'] for r in report] == ['deleted'] * 5
+    report = orion.batch_delete(ids[:1])
+    assert report[0]['status'] == 'not_found'
+
+
 def test_get_entities(orion, datamodel, docker_orion):
     classes = datamodel.get_classes()
     count = 0
@@ -84,6 +135,32 @@ def test_get_entities(orion, datamodel, docker_orion):
         count += len(orion.get_entities(c))
     assert count == len(datamodel.classes_file_list)
 
+def test_iter_entities(orion, datamodel, docker_orion):
+    for c in datamodel.get_classes():
+        total = orion.count_entities(c)
+        entities = list(orion.iter_entities(c, page_size=5))
+        assert len(entities) == total
+        assert len(set(e['id'] for e in entities)) == total
+        assert len(list(orion.iter_entities(c, page_size=5, max_items=3))) == min(3, total)
+
+
+def test_get_entities_page(orion, docker_orion):
+    entities, total = orion.get_entities_page('Command', offset=0, limit=5)
+    assert len(entities) == 5
+    assert total == orion.count_entities('Command')
+    assert len(orion.get_entities('Command', offset=5, limit=5)) == 5
+
+
+def test_count_entities(orion, datamodel, docker_orion):
+    classes = datamodel.get_classes()
+    assert orion.count_entities_by_types(classes) == len(datamodel.classes_file_list)
+    for c in classes:
+        assert orion.count_entities(c) == len(orion.get_entities(c))
+
+
+def test_count_subscriptions(orion, docker_orion):
+    assert orion.count_subscriptions() == len(orion.get_subscriptions())
+
 def test_get_version(orion, docker_orion):
     version = orion.get_version()
     assert len(version) > 0
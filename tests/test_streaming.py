@@ -0,0 +1,64 @@
+import json
+
+from flask import Flask
+from prometheus_client import REGISTRY
+
+import metrics
+import streaming
+from streaming import iter_json, stream_json
+
+
+def encode(*args, **kwargs):
+    return b''.join(iter_json(*args, **kwargs))
+
+
+def test_array():
+    assert json.loads(encode(iter([]))) == []
+    assert json.loads(encode(iter([1, {'a': '"quoted"'}]))) == [1, {'a': '"quoted"'}]
+
+
+def test_envelope():
+    assert json.loads(encode(iter([[1, 2]]), envelope={})) == {'data': [[1, 2]]}
+    response = {'draw': 1, 'recordsTotal': 2, 'data': None}
+    assert json.loads(encode(iter(['x', 'y']), envelope=response)) == {'draw': 1, 'recordsTotal': 2,
+                                                                       'data': ['x', 'y']}
+
+
+def test_chunks(monkeypatch):
+    monkeypatch.setattr(streaming, 'CHUNK_SIZE', 100)
+    items = ({'id': 'urn:ngsi-ld:Sensor:{}'.format(i)} for i in range(100))
+    chunks = list(iter_json(items))
+    assert len(chunks) > 10
+    assert max(len(chunk) for chunk in chunks) < 200
+    assert len(json.loads(b''.join(chunks))) == 100
+
+
+def test_stream_errors():
+    app = Flask(__name__)
+    metrics.init_app(app)
+
+    def pages(fail):
+        if fail:
+            raise ValueError('upstream failed')
+        yield 1
+        yield 2
+
+    @app.route('/items')
+    def items():
+        return stream_json(pages(False))
+
+    @app.route('/failing')
+    def failing():
+        return stream_json(pages(True))
+
+    def count():
+        return REGISTRY.get_sample_value('entirety_http_request_seconds_count',
+                                         {'endpoint': 'items', 'method': 'GET', 'status': '2xx'}) or 0
+
+    client = app.test_client()
+    before = count()
+    r = client.get('/items')
+    assert json.loads(r.data) == [1, 2]
+    r.close()
+    assert count() == before + 1
+    assert client.get('/failing').status_code == 500
@@ -0,0 +1,62 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, g, render_template_string
+
+import timing
+
+
+def test_nested_spans():
+    record = timing.Timing()
+    timing._local.timing = record
+    try:
+        with timing.span('forms'):
+            with timing.span('datamodel'):
+                time.sleep(0.05)
+            with timing.span('forms'):
+                time.sleep(0.01)
+    finally:
+        timing._local.timing = None
+    assert record.spans['datamodel'][0] >= 0.05
+    assert record.spans['forms'][0] < 0.05
+    assert record.spans['forms'][1] == 1
+
+
+def test_bind():
+    record = timing.Timing()
+    timing._local.timing = record
+    try:
+        func = timing.bind(timing.timed('orion')(lambda: time.sleep(0.01)))
+    finally:
+        timing._local.timing = None
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda _: func(), range(2)))
+    assert record.spans['orion'][1] == 2
+
+
+def test_server_timing(tmp_path):
+    app = Flask(__name__)
+    timing.init_app(app)
+    profiler = timing.Profiler(config={'admins': ['admin'], 'profile_dir': str(tmp_path)})
+
+    @app.before_request
+    def start_profiler():
+        g.user = request_user
+        if profiler.requested(g.user):
+            profiler.start()
+
+    app.after_request(profiler.stop)
+
+    @app.route('/')
+    def index():
+        return render_template_string('{{ 1 + 1 }}')
+
+    client = app.test_client()
+    request_user = 'user'
+    r = client.get('/?profile')
+    assert r.headers['Server-Timing'].startswith('render;dur=')
+    assert 'X-Profile' not in r.headers
+
+    request_user = 'admin'
+    r = client.get('/', headers={'X-Profile': '1'})
+    assert (tmp_path / r.headers['X-Profile']).exists()